@@ -2,84 +2,318 @@
 Implements a sitemap.xml parser for introspection
 """
 
+import concurrent.futures
 import datetime
 import logging
+import queue
+import threading
 import sqlmodel
+import smcat.metrics
 import smcat.sitemap
 import smcat.models
+import smcat.transport
 
 _L = logging.getLogger("smcat")
 
+# Elements of an item url stored in columns rather than properties
+_ITEM_COLUMNS = (
+    smcat.sitemap.SM_LOC,
+    smcat.sitemap.SM_LASTMOD,
+    smcat.sitemap.SM_PRIORITY,
+    smcat.sitemap.SM_CHANGEFREQ,
+)
 
 
-def addTreeToDatabase(engine, tree, commit_batch=100):
-    counter = 0
-    keys = []
-    with smcat.models.get_session(engine) as session:
-        for item in tree:
-            item_kind = item.get('kind')
-            if item_kind == 'sitemap':
-                _url = item.get('url', {}).get(smcat.sitemap.SM_LOC)
-                if _url is None:
-                    _L.warning("URL is required for a sitemap entry")
-                    continue
-                existing = (
-                    session.query(smcat.models.SitemapIndex)
-                        .filter(smcat.models.SitemapIndex.loc == _url)
-                        .one_or_none()
-                )
-                if existing is None:
-                    _i = item.get('url')
-                    entry = smcat.models.SitemapIndex(
-                        loc = _i.get(smcat.sitemap.SM_LOC),
-                        lastmod = _i.get(smcat.sitemap.SM_LASTMOD),
-                        source = item.get('source')
-                    )
-                    _L.info(entry)
-                    session.add(entry)
-                else:
-                    _ = session.merge(existing)
-                session.commit()
-            elif item_kind == 'url':
-                _url = item.get('url', {}).get(smcat.sitemap.SM_LOC)
-                if _url is None:
-                    _L.warning("URL is required for a sitemap entry")
-                    return
-                if _url in keys:
-                    # Existing uncommitted entry
-                    # Commit outstanding entries and proceed
-                    session.commit()
-                    keys = []
-                else:
-                    keys.append(_url)
-                existing = (
-                    session.query(smcat.models.SitemapEntry)
-                        .filter(smcat.models.SitemapEntry.loc == _url)
-                        .one_or_none()
+def _itemProperties(url):
+    """Return the elements of an item url other than _ITEM_COLUMNS, or None"""
+    properties = {k: v for k, v in url.items() if k not in _ITEM_COLUMNS}
+    return properties or None
+
+
+def _writeItem(engine, writer, item, crawl_id=None):
+    """Add item to writer, returning True if it was a sitemap or url entry"""
+    if isinstance(item, smcat.sitemap.SitemapRecord):
+        if item.kind == 'sitemap':
+            writer.addIndex(
+                item.loc,
+                lastmod=item.lastmod,
+                source=item.source,
+                properties=item.extras,
+            )
+        elif item.kind == 'url':
+            writer.addEntry(
+                item.loc,
+                lastmod=item.lastmod,
+                priority=item.priority,
+                changefreq=item.changefreq,
+                source=item.source,
+                properties=item.extras,
+            )
+        elif item.kind == 'completed':
+            writer.flush()
+            if crawl_id is not None:
+                smcat.models.addCheckpoint(
+                    engine,
+                    crawl_id,
+                    item.loc,
+                    parsed=bool(item.extras and item.extras.get("parsed")),
+                    lastmod=item.lastmod,
                 )
-                if existing is None:
-                    _i = item['url']
-                    entry = smcat.models.SitemapEntry(
-                        loc=_i.get(smcat.sitemap.SM_LOC),
-                        priority=_i.get(smcat.sitemap.SM_PRIORITY),
-                        lastmod=_i.get(smcat.sitemap.SM_LASTMOD),
-                        changefreq=_i.get(smcat.sitemap.SM_CHANGEFREQ),
-                        source=item.get("source")
-                    )
-                    _L.info(entry)
-                    session.add(entry)
-                else:
-                    _ = session.merge(existing)
-            counter += 1
-            if counter % commit_batch == 0:
-                session.commit()
-                keys = []
-                _L.debug("Added %s entries", counter)
-        session.commit()
-
-
-def loadSitemap(url, engine=None, commit_batch=100):
-    tree = smcat.sitemap.SiteMap(url)
+            return False
+        else:
+            return False
+        return True
+    item_kind = item.get('kind')
+    if item_kind == 'sitemap':
+        _i = item.get('url', {})
+        _url = _i.get(smcat.sitemap.SM_LOC)
+        if _url is None:
+            _L.warning("URL is required for a sitemap entry")
+            return False
+        writer.addIndex(
+            _url,
+            lastmod=_i.get(smcat.sitemap.SM_LASTMOD),
+            source=item.get('source'),
+            properties=_itemProperties(_i),
+        )
+    elif item_kind == 'url':
+        _i = item.get('url', {})
+        _url = _i.get(smcat.sitemap.SM_LOC)
+        if _url is None:
+            _L.warning("URL is required for a sitemap entry")
+            return False
+        writer.addEntry(
+            _url,
+            lastmod=_i.get(smcat.sitemap.SM_LASTMOD),
+            priority=_i.get(smcat.sitemap.SM_PRIORITY),
+            changefreq=_i.get(smcat.sitemap.SM_CHANGEFREQ),
+            source=item.get("source"),
+            properties=_itemProperties(_i),
+        )
+    else:
+        return False
+    return True
+
+
+def addTreeToDatabase(
+    engine,
+    tree,
+    commit_batch=1000,
+    on_batch=None,
+    crawl_id=None,
+    stats=None,
+    writer_thread=False,
+):
+    """
+    Write the sitemap and url entries of tree to the database.
+
+    tree yields either the items of a SiteMap or SitemapRecords, as from
+    SiteMap.records(). Entries are upserted in batches of commit_batch rows.
+    Returns a dict of table name to BatchResult with the inserted, updated
+    and unchanged totals.
+
+    On a "completed" record, outstanding entries are flushed and, if crawl_id
+    is provided, a checkpoint is recorded for the sitemap. Rows are stamped
+    with crawl_id as their generation. If stats, a smcat.metrics.CrawlStats,
+    is provided, database write time is added to it for each source sitemap.
+
+    If writer_thread is True, writes are made by a smcat.models.WriterThread
+    so iterating tree does not wait on the database.
+    """
+    writer = smcat.models.BatchWriter(
+        engine,
+        batch_size=commit_batch,
+        on_batch=on_batch,
+        generation=crawl_id,
+        stats=stats,
+    )
+    if writer_thread:
+        with smcat.models.WriterThread() as thread:
+            for item in tree:
+                thread.submit(_writeItem, engine, writer, item, crawl_id=crawl_id)
+            thread.submit(writer.flush)
+    else:
+        with writer:
+            for item in tree:
+                _writeItem(engine, writer, item, crawl_id=crawl_id)
+    for result in writer.totals.values():
+        _L.info("Loaded %s", result)
+    if writer.duplicates:
+        _L.info("Merged %s duplicate url entries", writer.duplicates)
+    return writer.totals
+
+
+def loadSitemap(
+    url,
+    engine=None,
+    commit_batch=1000,
+    conditional=False,
+    incremental=False,
+    resume=False,
+    writer_thread=False,
+    **kwargs
+):
+    """
+    Crawl the sitemap at url, adding entries to the database if engine is provided.
+
+    If conditional is True, the ETag and Last-Modified validators of each
+    sitemap are stored in the database and sent with the next load, and
+    sitemaps that have not been modified are skipped.
+
+    If incremental is True, child sitemaps whose sitemapindex lastmod is not
+    newer than the lastmod stored in the database are not fetched.
+
+    With an engine, each load is recorded as a Crawl with a checkpoint per
+    committed sitemap. When the load finishes, entries of fully parsed
+    sitemaps that were not seen are marked removed. If resume is True, the
+    latest unfinished crawl of url is continued, skipping the sitemaps it
+    already committed.
+
+    If writer_thread is True, the database is written by a separate thread.
+
+    Additional keyword arguments are passed to smcat.sitemap.SiteMap.
+    """
+    validators = None
+    if conditional and engine is not None:
+        validators = smcat.models.DatabaseValidatorCache(engine)
+    if incremental and engine is not None:
+        kwargs["known_lastmod"] = smcat.models.sitemapLastmods(engine)
+    crawl = None
     if engine is not None:
-        addTreeToDatabase(engine, tree, commit_batch=commit_batch)
+        crawl = smcat.models.startCrawl(engine, url, resume=resume)
+        kwargs["completed"] = smcat.models.crawlCheckpoints(engine, crawl.id)
+        if kwargs["completed"]:
+            _L.info("Resuming crawl %s, %s sitemaps done", crawl.id, len(kwargs["completed"]))
+    tree = smcat.sitemap.SiteMap(url, validators=validators, **kwargs)
+    if engine is not None:
+        addTreeToDatabase(
+            engine,
+            tree.records(completed=True),
+            commit_batch=commit_batch,
+            crawl_id=crawl.id,
+            stats=tree.stats,
+            writer_thread=writer_thread,
+        )
+        if validators is not None:
+            validators.commit()
+        smcat.models.sweepRemoved(engine, crawl.id)
+        smcat.models.finishCrawl(engine, crawl.id)
     return tree
+
+
+# Records buffered between the crawling threads and the writer
+SYNC_QUEUE_SIZE = 10000
+
+
+def _crawlRoot(records, crawl_id, tree, stop):
+    """Put (crawl_id, record) on records for each record of tree.
+
+    Finishes with (crawl_id, None), or (crawl_id, exception) on failure.
+    Returns early if stop is set.
+    """
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                records.put((crawl_id, item), timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for record in tree.records(completed=True):
+            if not put(record):
+                return
+    except Exception as e:
+        _L.exception("Crawl of %s failed", tree.sitemap_url)
+        put(e)
+        return
+    put(None)
+
+
+def syncSitemaps(
+    urls,
+    engine,
+    workers=4,
+    per_host=2,
+    commit_batch=1000,
+    conditional=False,
+    incremental=False,
+    resume=False,
+    session=None,
+    **kwargs
+):
+    """
+    Crawl the sitemaps at urls concurrently, adding entries to the database.
+
+    Each root is crawled in its own thread, at most workers at a time, and
+    requests to a host are limited to per_host across all of them. Records
+    are passed through a bounded queue to the calling thread, which is the
+    only one writing to the database. Each root is recorded as a Crawl,
+    with checkpoints and removal as for loadSitemap. A root that fails is
+    logged and left unfinished, so it can be resumed.
+
+    Returns a dict of root url to the totals from its BatchWriter, or None
+    for roots that failed.
+
+    Additional keyword arguments are passed to smcat.sitemap.SiteMap.
+    """
+    validators = None
+    if conditional:
+        validators = smcat.models.DatabaseValidatorCache(engine)
+    if incremental:
+        kwargs["known_lastmod"] = smcat.models.sitemapLastmods(engine)
+    if session is None:
+        session = smcat.transport.createSession(
+            pool_size=max(smcat.transport.DEFAULT_POOL_SIZE, per_host),
+            pool_hosts=max(smcat.transport.DEFAULT_POOL_SIZE, workers),
+        )
+    host_limits = smcat.sitemap.HostLimits(per_host)
+    stats = kwargs.pop("stats", None) or smcat.metrics.CrawlStats()
+    records = queue.Queue(maxsize=SYNC_QUEUE_SIZE)
+    stop = threading.Event()
+    roots = {}
+    writers = {}
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, workers), thread_name_prefix="sync"
+    ) as executor:
+        try:
+            for url in dict.fromkeys(urls):
+                crawl = smcat.models.startCrawl(engine, url, resume=resume)
+                tree = smcat.sitemap.SiteMap(
+                    url,
+                    validators=validators,
+                    session=session,
+                    host_limits=host_limits,
+                    stats=stats,
+                    completed=smcat.models.crawlCheckpoints(engine, crawl.id),
+                    **kwargs
+                )
+                roots[crawl.id] = url
+                writers[crawl.id] = smcat.models.BatchWriter(
+                    engine, batch_size=commit_batch, generation=crawl.id, stats=stats
+                )
+                executor.submit(_crawlRoot, records, crawl.id, tree, stop)
+            while writers:
+                crawl_id, item = records.get()
+                writer = writers[crawl_id]
+                if item is None or isinstance(item, Exception):
+                    writer.flush()
+                    del writers[crawl_id]
+                    url = roots[crawl_id]
+                    if item is None:
+                        smcat.models.sweepRemoved(engine, crawl_id)
+                        smcat.models.finishCrawl(engine, crawl_id)
+                        results[url] = writer.totals
+                        _L.info("Synced %s", url)
+                    else:
+                        results[url] = None
+                    continue
+                _writeItem(engine, writer, item, crawl_id=crawl_id)
+        finally:
+            stop.set()
+    if validators is not None:
+        validators.commit()
+    return results
@@ -1,12 +1,16 @@
 """
 Script for viewing a sitemap
 """
+import os
 import sys
 import logging
 import click
 import dateparser
 import smcat
+import smcat.export
 import smcat.models
+import smcat.sitemap
+import smcat.transport
 import sqlalchemy.sql
 
 LOG_LEVELS = {
@@ -22,6 +26,15 @@ LOG_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
 LOG_FORMAT = "%(asctime)s %(name)s:%(levelname)s: %(message)s"
 _L = logging.getLogger("smcat")
 
+def getEngine(ctx, bulk_load=False):
+    """Return the database engine, creating it on first use"""
+    engine = ctx.obj.get("engine", None)
+    if engine is None and ctx.obj.get("dbcnstr") is not None:
+        engine = smcat.models.init_db(ctx.obj["dbcnstr"], bulk_load=bulk_load)
+        ctx.obj["engine"] = engine
+    return engine
+
+
 @click.group()
 @click.option(
     "-V",
@@ -37,8 +50,34 @@ _L = logging.getLogger("smcat")
     help="Database connection string",
     show_default=True
 )
+@click.option(
+    "--connect-timeout",
+    default=smcat.transport.DEFAULT_CONNECT_TIMEOUT,
+    help="Seconds to wait for a connection",
+    show_default=True
+)
+@click.option(
+    "--read-timeout",
+    default=smcat.transport.DEFAULT_READ_TIMEOUT,
+    help="Seconds to wait for data from a server",
+    show_default=True
+)
+@click.option(
+    "--retries",
+    default=smcat.transport.DEFAULT_RETRIES,
+    help="Retries on connection errors, 429 and 5xx responses",
+    show_default=True
+)
+@click.option(
+    "--pool-size",
+    default=smcat.transport.DEFAULT_POOL_SIZE,
+    help="Maximum connections kept open per host",
+    show_default=True
+)
 @click.pass_context
-def main(ctx, verbosity, dbcnstr) -> int:
+def main(
+    ctx, verbosity, dbcnstr, connect_timeout, read_timeout, retries, pool_size
+) -> int:
     ctx.ensure_object(dict)
     verbosity = verbosity.upper()
     logging.basicConfig(
@@ -48,10 +87,15 @@ def main(ctx, verbosity, dbcnstr) -> int:
     )
     if verbosity not in LOG_LEVELS.keys():
         _L.warning("%s is not a log level, set to INFO", verbosity)
-    engine = None
-    if dbcnstr is not None:
-        engine = smcat.models.init_db(dbcnstr)
-    ctx.obj['engine'] = engine
+    # The database is opened by the commands that use it
+    ctx.obj['dbcnstr'] = dbcnstr
+    ctx.obj['engine'] = None
+    ctx.obj['session_options'] = {
+        "connect_timeout": connect_timeout,
+        "read_timeout": read_timeout,
+        "retries": retries,
+        "pool_size": pool_size,
+    }
 
     '''tree = smcat.loadSitemap(url, engine=engine)
     if engine is not None:
@@ -74,8 +118,84 @@ def main(ctx, verbosity, dbcnstr) -> int:
     default=None,
     help="Sitemap URL to access."
 )
-def load(ctx, url):
-    engine = ctx.obj.get("engine", None)
+@click.option(
+    "-c",
+    "--concurrency",
+    default=1,
+    help="Number of child sitemaps to fetch concurrently",
+    show_default=True
+)
+@click.option(
+    "--per-host",
+    default=2,
+    help="Maximum concurrent requests per host",
+    show_default=True
+)
+@click.option(
+    "--streaming",
+    is_flag=True,
+    default=False,
+    help="Parse sitemaps incrementally as they are downloaded"
+)
+@click.option(
+    "--conditional",
+    is_flag=True,
+    default=False,
+    help="Skip sitemaps not modified since the previous load"
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Skip child sitemaps whose sitemapindex lastmod is unchanged"
+)
+@click.option(
+    "-w",
+    "--workers",
+    default=0,
+    help="Number of processes parsing sitemap documents",
+    show_default=True
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Continue the last interrupted load, skipping sitemaps already committed"
+)
+@click.option(
+    "--stats",
+    "show_stats",
+    is_flag=True,
+    default=False,
+    help="Print counters and timings for each sitemap after loading"
+)
+@click.option(
+    "--stats-file",
+    type=click.File("a"),
+    default=None,
+    help="Append counters and timings for each sitemap as JSON lines to this file"
+)
+@click.option(
+    "--writer-thread/--no-writer-thread",
+    default=True,
+    help="Write to the database from a separate thread",
+    show_default=True
+)
+def load(
+    ctx,
+    url,
+    concurrency,
+    per_host,
+    streaming,
+    conditional,
+    incremental,
+    workers,
+    resume,
+    show_stats,
+    stats_file,
+    writer_thread,
+):
+    engine = getEngine(ctx, bulk_load=True)
     if engine is None:
         raise ValueError("Unexpected None engine.")
     if url is None:
@@ -91,12 +211,239 @@ def load(ctx, url):
             return
         url = roots[0][0]
     print(f"URL = {url}")
-    tree = smcat.loadSitemap(url, engine=engine)
+    tree = smcat.loadSitemap(
+        url,
+        engine=engine,
+        max_workers=max(concurrency, workers),
+        per_host=per_host,
+        streaming=streaming,
+        conditional=conditional,
+        incremental=incremental,
+        parse_workers=workers,
+        resume=resume,
+        writer_thread=writer_thread,
+        session=smcat.transport.createSession(**ctx.obj["session_options"]),
+    )
+    if show_stats:
+        print(tree.stats)
+    if stats_file is not None:
+        tree.stats.writeJsonl(stats_file)
     with smcat.models.get_session(engine) as session:
         for row in session.execute(sqlalchemy.sql.select(smcat.models.SitemapEntry)):
             print(row[0])
         session.close_all()
 
+@main.command()
+@click.pass_context
+@click.option(
+    "-f",
+    "--roots",
+    "roots_file",
+    type=click.File("r"),
+    default=None,
+    help="File listing root sitemap URLs, one per line. Default is the roots in the database."
+)
+@click.option(
+    "-c",
+    "--concurrency",
+    default=4,
+    help="Number of roots to crawl concurrently",
+    show_default=True
+)
+@click.option(
+    "--per-host",
+    default=2,
+    help="Maximum concurrent requests per host, across all roots",
+    show_default=True
+)
+@click.option(
+    "--conditional",
+    is_flag=True,
+    default=False,
+    help="Skip sitemaps not modified since the previous load"
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Skip child sitemaps whose sitemapindex lastmod is unchanged"
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Continue interrupted crawls, skipping sitemaps already committed"
+)
+def sync(ctx, roots_file, concurrency, per_host, conditional, incremental, resume):
+    """Load every root sitemap, several at a time."""
+    engine = getEngine(ctx, bulk_load=True)
+    if engine is None:
+        raise ValueError("Unexpected None engine.")
+    if roots_file is not None:
+        roots = []
+        for line in roots_file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                roots.append(line)
+    else:
+        roots = smcat.models.getCrawlRoots(engine)
+    if len(roots) == 0:
+        _L.error("No root URLs in database and none provided.")
+        return
+    session_options = dict(ctx.obj['session_options'])
+    session_options["pool_size"] = max(session_options["pool_size"], per_host)
+    session_options["pool_hosts"] = max(session_options["pool_size"], concurrency)
+    results = smcat.syncSitemaps(
+        roots,
+        engine,
+        workers=concurrency,
+        per_host=per_host,
+        conditional=conditional,
+        incremental=incremental,
+        resume=resume,
+        session=smcat.transport.createSession(**session_options),
+    )
+    for url, totals in results.items():
+        if totals is None:
+            print(f"{url}: failed")
+            continue
+        print(f"{url}: " + ", ".join(str(t) for t in totals.values()))
+
+
+@main.command()
+@click.pass_context
+@click.option(
+    "-o",
+    "--output",
+    default="-",
+    help="Output file, - for stdout",
+    show_default=True
+)
+@click.option(
+    "-f",
+    "--format",
+    "fmt",
+    type=click.Choice(smcat.export.FORMATS),
+    default="jsonl",
+    help="Output format, parquet requires pyarrow and an output file",
+    show_default=True
+)
+@click.option(
+    "-s",
+    "--source",
+    default=None,
+    help="Only entries from this sitemap URL"
+)
+@click.option(
+    "--since",
+    default=None,
+    help="Only entries with lastmod after this time"
+)
+@click.option(
+    "--until",
+    default=None,
+    help="Only entries with lastmod up to this time"
+)
+@click.option(
+    "--removed",
+    is_flag=True,
+    default=False,
+    help="Include entries removed from their sitemap"
+)
+@click.option(
+    "--batch-size",
+    default=smcat.export.DEFAULT_BATCH_SIZE,
+    help="Rows read and written at a time",
+    show_default=True
+)
+def export(ctx, output, fmt, source, since, until, removed, batch_size):
+    """Stream url entries to JSON lines, CSV or Parquet."""
+    engine = getEngine(ctx)
+    if engine is None:
+        raise ValueError("Unexpected None engine.")
+    settings = {'RETURN_AS_TIMEZONE_AWARE': True}
+    if since is not None:
+        since = dateparser.parse(since, settings=settings)
+    if until is not None:
+        until = dateparser.parse(until, settings=settings)
+    options = {
+        "source": source,
+        "since": since,
+        "until": until,
+        "include_removed": removed,
+        "batch_size": batch_size,
+    }
+    if fmt == "parquet":
+        if output == "-":
+            raise click.UsageError("Parquet output requires an output file")
+        n = smcat.export.exportEntries(engine, output, format=fmt, **options)
+    else:
+        with click.open_file(output, "w") as dest:
+            n = smcat.export.exportEntries(engine, dest, format=fmt, **options)
+    _L.info("Wrote %s entries to %s", n, output)
+
+
+@main.command()
+@click.pass_context
+@click.argument("url")
+@click.option(
+    "-f",
+    "--format",
+    "fmt",
+    type=click.Choice(smcat.export.RECORD_FORMATS),
+    default="jsonl",
+    help="Output format",
+    show_default=True
+)
+@click.option(
+    "-k",
+    "--kind",
+    type=click.Choice(("url", "sitemap", "all")),
+    default="url",
+    help="Kind of entries to write",
+    show_default=True
+)
+@click.option(
+    "-c",
+    "--concurrency",
+    default=1,
+    help="Number of child sitemaps to fetch concurrently",
+    show_default=True
+)
+@click.option(
+    "--per-host",
+    default=2,
+    help="Maximum concurrent requests per host",
+    show_default=True
+)
+@click.option(
+    "--streaming/--no-streaming",
+    default=True,
+    help="Parse sitemaps incrementally as they are downloaded",
+    show_default=True
+)
+def cat(ctx, url, fmt, kind, concurrency, per_host, streaming):
+    """Write the entries of a sitemap to stdout as they are parsed, without a database."""
+    kinds = ("url", "sitemap") if kind == "all" else (kind,)
+    sm = smcat.sitemap.SiteMap(
+        url,
+        max_workers=concurrency,
+        per_host=per_host,
+        streaming=streaming,
+        session=smcat.transport.createSession(**ctx.obj["session_options"]),
+    )
+    try:
+        n = smcat.export.writeRecords(
+            sm.records(completed=True), sys.stdout, format=fmt, kinds=kinds
+        )
+    except BrokenPipeError:
+        # The reader went away, as with | head. Discard the rest of the output.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return
+    _L.info("Wrote %s entries", n)
+
+
 @main.command()
 @click.pass_context
 @click.option(
@@ -105,8 +452,14 @@ def load(ctx, url):
     default=None,
     help="Changes since t"
 )
-def recent(ctx, tlast):
-    engine = ctx.obj.get("engine", None)
+@click.option(
+    "--removed",
+    is_flag=True,
+    default=False,
+    help="Include entries removed from their sitemap since t"
+)
+def recent(ctx, tlast, removed):
+    engine = getEngine(ctx)
     if engine is None:
         raise ValueError("Unexpected None engine.")
     if tlast is None:
@@ -114,7 +467,7 @@ def recent(ctx, tlast):
         print(f"Most recent lastMod = {most_recent}")
         return
     dtlast = dateparser.parse(tlast, settings={'RETURN_AS_TIMEZONE_AWARE': True})
-    for entry in smcat.models.changedSince(engine, tlast):
+    for entry in smcat.models.changedSince(engine, dtlast, include_removed=removed):
         print(entry)
 
 
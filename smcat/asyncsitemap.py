@@ -0,0 +1,226 @@
+"""
+asyncio support for crawling sitemaps.
+
+AsyncSiteMap is a SiteMap that fetches with an httpx.AsyncClient and is
+iterated with ``async for``, so a single event loop can crawl many sites.
+Parsing, filtering, rule callbacks and robots.txt handling are inherited
+from SiteMap, so overrides of parseSitemap, sitemapFilter and parseUrl
+apply to both.
+
+httpx is an optional dependency, installed with:
+
+    pip install smcat[async]
+"""
+import asyncio
+import collections
+import logging
+import time
+import types
+import urllib.parse
+import smcat.sitemap
+import smcat.transport
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+L = logging.getLogger("asyncsitemap")
+
+DEFAULT_CONCURRENCY = 10
+
+
+class AsyncResponse(object):
+    """
+    Presents an httpx.Response with the attributes SiteMap reads from a
+    requests.Response.
+    """
+
+    def __init__(self, response):
+        self.url = str(response.url)
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.content
+        self.encoding = response.encoding
+        self.history = [AsyncResponse(r) for r in response.history]
+        self._response = response
+
+    @property
+    def text(self):
+        return self._response.text
+
+    def iter_content(self, chunk_size=1):
+        return smcat.sitemap.bodyChunks(self.content, chunk_size)
+
+    def close(self):
+        pass
+
+
+class AsyncSiteMap(smcat.sitemap.SiteMap):
+    def __init__(
+        self,
+        url,
+        max_concurrency: int = DEFAULT_CONCURRENCY,
+        client=None,
+        **kwargs,
+    ):
+        """
+        Initialize an AsyncSiteMap object
+
+        Args:
+            url: The url of a sitemap xml or gzipped xml document
+            max_concurrency: Maximum number of requests in flight. Child
+              sitemaps listed in a sitemapindex are fetched concurrently
+              up to this limit, and to per_host for each host.
+            client: Optional httpx.AsyncClient used for all requests. The
+              default client uses the smcat.transport timeouts and is closed
+              when iteration finishes.
+            kwargs: As for SiteMap. streaming and parse_workers are not
+              supported and are ignored.
+
+        """
+        if httpx is None:
+            raise ImportError(
+                "AsyncSiteMap requires httpx, install with: pip install smcat[async]"
+            )
+        for option in ("streaming", "parse_workers"):
+            if kwargs.pop(option, None):
+                L.warning("%s is not supported by AsyncSiteMap", option)
+        super().__init__(url, **kwargs)
+        # _afetch reads whole bodies and records their bytes and fetch time
+        self._stream_bodies = False
+        self.max_concurrency = max(1, max_concurrency)
+        self._client = client
+        self._semaphore = None
+        self._host_semaphores = {}
+
+    def _createClient(self):
+        return httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                smcat.transport.DEFAULT_READ_TIMEOUT,
+                connect=smcat.transport.DEFAULT_CONNECT_TIMEOUT,
+            ),
+            limits=httpx.Limits(max_connections=self.max_concurrency),
+            transport=httpx.AsyncHTTPTransport(
+                retries=smcat.transport.DEFAULT_RETRIES
+            ),
+            follow_redirects=True,
+        )
+
+    def _hostSemaphore(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_host)
+            self._host_semaphores[host] = semaphore
+        return semaphore
+
+    async def _afetch(self, client, url):
+        headers = None
+        if self.validators is not None:
+            headers = self.validators.conditionalHeaders(url)
+        t0 = time.perf_counter()
+        async with self._semaphore, self._hostSemaphore(url):
+            response = await client.get(url, headers=headers)
+        stats = self.stats.sitemap(url)
+        stats.status = response.status_code
+        self.stats.add(url, "latency_seconds", response.elapsed.total_seconds())
+        self.stats.add(url, "bytes", len(response.content))
+        self.stats.add(url, "fetch_seconds", time.perf_counter() - t0)
+        return AsyncResponse(response)
+
+    async def _aiterFetches(self, client, actions, depth=1):
+        """
+        Yield (action, task) for each action, where task is the pending
+        fetch for sitemapindex and robotsitemap actions, else None. Fetches
+        are started ahead of the action being yielded. Sitemaps are fetched
+        as depth levels below the root.
+        """
+        window = collections.deque()
+        pending = 0
+        try:
+            for action in actions:
+                task = None
+                url = self._actionUrl(action, depth)
+                if url is not None:
+                    task = asyncio.ensure_future(self._afetch(client, url))
+                    pending += 1
+                window.append((action, task))
+                while pending > 2 * self.max_concurrency or (
+                    pending == 0 and window
+                ):
+                    action, task = window.popleft()
+                    if task is not None:
+                        pending -= 1
+                    yield action, task
+            while window:
+                yield window.popleft()
+        finally:
+            for action, task in window:
+                if task is not None:
+                    task.cancel()
+
+    async def _ascanItems(self, client, iter=None, response=None):
+        if not isinstance(iter, types.GeneratorType):
+            yield iter
+            if response is not None:
+                self.sitemapCompleted(response, self._documentComplete(response))
+            return
+        # Work stack of [actions, response, depth, complete] as for
+        # SiteMap._scanItems
+        stack = [[self._aiterFetches(client, iter, 1), response, 0, True]]
+        try:
+            while stack:
+                actions, response, depth, _ = stack[-1]
+                try:
+                    action, fetch = await actions.__anext__()
+                except StopAsyncIteration:
+                    self._popDocument(stack)
+                    continue
+                task = action.get("task", None)
+                yield action
+                if task in smcat.sitemap.FETCH_TASKS:
+                    cb = action["body"].pop("cb")
+                    yield action["body"]
+                    r = await fetch
+                    result = cb(r)
+                    if isinstance(result, types.GeneratorType):
+                        child_depth = depth + 1
+                        actions = self._aiterFetches(client, result, child_depth + 1)
+                        stack.append([actions, r, child_depth, True])
+                    else:
+                        yield result
+                        stack.append([None, r, depth + 1, True])
+                        self._popDocument(stack)
+                elif task in ("sitemapunchanged", "sitemapskipped"):
+                    yield action["body"]
+                elif task == "url":
+                    cb = action["body"].pop("cb")
+                    result = cb(action["body"])
+                    if isinstance(result, types.GeneratorType):
+                        actions = self._aiterFetches(client, result, depth + 1)
+                        stack.append([actions, None, depth, True])
+                    else:
+                        yield result
+        finally:
+            # Cancel the fetches of documents left unfinished
+            for actions, _, _, _ in reversed(stack):
+                if actions is not None:
+                    await actions.aclose()
+
+    async def __aiter__(self):
+        self._startCrawl()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._host_semaphores = {}
+        client = self._client
+        if client is None:
+            client = self._createClient()
+        try:
+            response = await self._afetch(client, self.sitemap_url)
+            iter = self.parseSitemap(response)
+            async for item in self._ascanItems(client, iter, response):
+                L.debug(f"ITER: {item}")
+                yield item
+        finally:
+            if self._client is None:
+                await client.aclose()
@@ -0,0 +1,282 @@
+"""
+Export of sitemap entries to JSON lines, CSV or Parquet.
+
+exportEntries writes entries stored in the database. writeRecords writes
+SitemapRecords as they are crawled, without a database.
+
+Rows are read with a streaming Core select and written a batch at a time,
+so memory use does not depend on the number of entries exported. Parquet
+output requires the optional pyarrow dependency:
+
+    pip install smcat[parquet]
+"""
+import csv
+import datetime
+import json
+import logging
+import time
+import sqlalchemy
+import smcat.models
+import smcat.sitemap
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+_L = logging.getLogger("export")
+
+FORMATS = ("jsonl", "csv", "parquet")
+
+# Columns of SitemapEntry written, in order
+COLUMNS = (
+    "loc",
+    "lastmod",
+    "priority",
+    "changefreq",
+    "source",
+    "t_created",
+    "t_updated",
+    "t_removed",
+    "properties",
+)
+
+DEFAULT_BATCH_SIZE = 10000
+
+
+def entryBatches(
+    engine,
+    source=None,
+    since=None,
+    until=None,
+    include_removed=False,
+    batch_size=DEFAULT_BATCH_SIZE,
+):
+    """
+    Yield lists of SitemapEntry rows as tuples of COLUMNS.
+
+    Args:
+        engine: SQLAlchemy engine
+        source: Only entries from this sitemap url
+        since: Only entries with lastmod > since
+        until: Only entries with lastmod <= until
+        include_removed: Include entries marked removed
+        batch_size: Rows fetched from the cursor and yielded at a time
+    """
+    table = smcat.models.SitemapEntry.__table__
+    statement = sqlalchemy.select(*[table.c[c] for c in COLUMNS])
+    if source is not None:
+        statement = statement.where(table.c.source == source)
+    if since is not None:
+        statement = statement.where(table.c.lastmod > since)
+    if until is not None:
+        statement = statement.where(table.c.lastmod <= until)
+    if not include_removed:
+        statement = statement.where(table.c.t_removed == None)  # noqa: E711
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(statement)
+        for partition in result.partitions(batch_size):
+            yield partition
+
+
+def _jsonValue(v):
+    if isinstance(v, datetime.datetime):
+        return v.isoformat()
+    return v
+
+
+def _csvValue(column, v):
+    if column == "properties" and v is not None:
+        return json.dumps(v)
+    return _jsonValue(v)
+
+
+def writeJsonl(batches, dest):
+    """Write each row as a JSON object on its own line, returning the count"""
+    n = 0
+    for batch in batches:
+        lines = []
+        for row in batch:
+            lines.append(
+                json.dumps({c: _jsonValue(v) for c, v in zip(COLUMNS, row)})
+            )
+        if lines:
+            dest.write("\n".join(lines))
+            dest.write("\n")
+        n += len(lines)
+    return n
+
+
+def writeCsv(batches, dest):
+    """Write rows as CSV with a header, returning the count"""
+    writer = csv.writer(dest, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    n = 0
+    for batch in batches:
+        writer.writerows(
+            [
+                [_csvValue(c, v) for c, v in zip(COLUMNS, row)]
+                for row in batch
+            ]
+        )
+        n += len(batch)
+    return n
+
+
+def parquetSchema():
+    """
+    Return the pyarrow schema of exported entries.
+
+    The t_ columns are set from the current UTC time and are labelled UTC.
+    lastmod has no timezone: SQLite keeps the sitemap's local time with the
+    offset dropped, so the stored value can not be converted to UTC. Values
+    read with an offset, from databases that keep it, are written as UTC.
+    """
+    timestamp = pyarrow.timestamp("us", tz="UTC")
+    return pyarrow.schema(
+        [
+            ("loc", pyarrow.string()),
+            ("lastmod", pyarrow.timestamp("us")),
+            ("priority", pyarrow.float64()),
+            ("changefreq", pyarrow.string()),
+            ("source", pyarrow.string()),
+            ("t_created", timestamp),
+            ("t_updated", timestamp),
+            ("t_removed", timestamp),
+            ("properties", pyarrow.string()),
+        ]
+    )
+
+
+def _utc(v):
+    # The t_ columns are written from now(utc), SQLite returns them without
+    # the offset
+    if v is not None and v.tzinfo is None:
+        return v.replace(tzinfo=datetime.timezone.utc)
+    return v
+
+
+def writeParquet(batches, dest):
+    """Write rows to a Parquet file, one record batch per batch, returning the count"""
+    if pyarrow is None:
+        raise ImportError(
+            "Parquet export requires pyarrow, install with: pip install smcat[parquet]"
+        )
+    schema = parquetSchema()
+    utc = pyarrow.timestamp("us", tz="UTC")
+    timestamps = [i for i, c in enumerate(COLUMNS) if schema.field(c).type == utc]
+    properties = COLUMNS.index("properties")
+    n = 0
+    with pyarrow.parquet.ParquetWriter(dest, schema) as writer:
+        for batch in batches:
+            columns = [list(c) for c in zip(*batch)]
+            if not columns:
+                continue
+            for i in timestamps:
+                columns[i] = [_utc(v) for v in columns[i]]
+            columns[properties] = [
+                None if v is None else json.dumps(v) for v in columns[properties]
+            ]
+            writer.write_batch(pyarrow.record_batch(columns, schema=schema))
+            n += len(batch)
+    return n
+
+
+WRITERS = {
+    "jsonl": writeJsonl,
+    "csv": writeCsv,
+    "parquet": writeParquet,
+}
+
+
+def exportEntries(engine, dest, format="jsonl", **kwargs):
+    """
+    Write SitemapEntry rows to dest in format, returning the number written.
+
+    dest is a text file for jsonl and csv, a path or binary file for
+    parquet. Additional keyword arguments are passed to entryBatches.
+    """
+    if format not in WRITERS:
+        raise ValueError(f"Unknown export format: {format}")
+    n = WRITERS[format](entryBatches(engine, **kwargs), dest)
+    _L.info("Exported %s entries", n)
+    return n
+
+
+# Formats for writeRecords
+RECORD_FORMATS = ("jsonl", "tsv")
+
+# Fields of a SitemapRecord written by writeRecords, in order
+RECORD_FIELDS = ("kind", "loc", "lastmod", "priority", "changefreq", "source")
+
+
+class LineBuffer(object):
+    """
+    Collects lines and writes them to dest together.
+
+    Lines are written when max_lines are buffered, when the oldest buffered
+    line is older than interval seconds, or on flush().
+    """
+
+    def __init__(self, dest, max_lines=1000, interval=0.1):
+        self.dest = dest
+        self.max_lines = max_lines
+        self.interval = interval
+        self._lines = []
+        self._t_first = None
+
+    def write(self, line):
+        if not self._lines:
+            self._t_first = time.monotonic()
+        self._lines.append(line)
+        if (
+            len(self._lines) >= self.max_lines
+            or time.monotonic() - self._t_first >= self.interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            self.dest.write("".join(self._lines))
+            self._lines = []
+        self.dest.flush()
+
+
+def _tsvValue(v):
+    if v is None:
+        return ""
+    return str(_jsonValue(v)).replace("\t", " ").replace("\n", " ")
+
+
+def recordLine(record, format="jsonl"):
+    """Return record as a single line of JSON or tab separated values"""
+    if format == "tsv":
+        return "\t".join(_tsvValue(getattr(record, f)) for f in RECORD_FIELDS) + "\n"
+    d = {f: _jsonValue(getattr(record, f)) for f in RECORD_FIELDS}
+    if record.extras:
+        d["extras"] = record.extras
+    return json.dumps(d, separators=(",", ":"), default=str) + "\n"
+
+
+def writeRecords(records, dest, format="jsonl", kinds=("url",), interval=0.1):
+    """
+    Write records of the given kinds to dest as they arrive, returning the count.
+
+    records is from SiteMap.records(completed=True), output is flushed at
+    the end of each sitemap document as well as by LineBuffer.
+    """
+    if format not in RECORD_FORMATS:
+        raise ValueError(f"Unknown record format: {format}")
+    buffer = LineBuffer(dest, interval=interval)
+    n = 0
+    for record in records:
+        if record.kind == "completed":
+            buffer.flush()
+            continue
+        if record.kind not in kinds:
+            continue
+        buffer.write(recordLine(record, format))
+        n += 1
+    buffer.flush()
+    return n
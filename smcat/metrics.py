@@ -0,0 +1,155 @@
+"""
+Counters and timings for crawls.
+
+A CrawlStats collects a SitemapStats for each sitemap document fetched,
+recording where the time of a crawl went: fetching, decompressing,
+parsing and writing to the database.
+"""
+import contextlib
+import json
+import threading
+import time
+
+
+class SitemapStats(object):
+    """Counters and timings for a single sitemap url"""
+
+    # Summed by CrawlStats.totals
+    FIELDS = (
+        "bytes",
+        "fetch_seconds",
+        "latency_seconds",
+        "decompress_seconds",
+        "parse_seconds",
+        "entries",
+        "lastmod_failures",
+        "flush_seconds",
+    )
+
+    def __init__(self, url):
+        self.url = url
+        self.status = None
+        self.bytes = 0
+        # Time from sending the request until the body has been received
+        self.fetch_seconds = 0.0
+        # Time from sending the request until the response headers arrived
+        self.latency_seconds = 0.0
+        self.decompress_seconds = 0.0
+        self.parse_seconds = 0.0
+        self.entries = 0
+        self.lastmod_failures = 0
+        self.flush_seconds = 0.0
+
+    def asJsonDict(self):
+        res = {"url": self.url, "status": self.status}
+        for f in self.FIELDS:
+            res[f] = getattr(self, f)
+        return res
+
+    def __str__(self):
+        return (
+            f"{self.url}: status={self.status} bytes={self.bytes} "
+            f"entries={self.entries} lastmod_failures={self.lastmod_failures} "
+            f"fetch={self.fetch_seconds:.3f}s latency={self.latency_seconds:.3f}s "
+            f"decompress={self.decompress_seconds:.3f}s "
+            f"parse={self.parse_seconds:.3f}s flush={self.flush_seconds:.3f}s"
+        )
+
+
+class CrawlStats(object):
+    """
+    SitemapStats for each sitemap of a crawl, keyed by requested url.
+
+    Updates are thread safe, so one CrawlStats can be shared by fetch
+    threads and by several SiteMaps.
+    """
+
+    def __init__(self):
+        self._sitemaps = {}
+        self._lock = threading.Lock()
+
+    def sitemap(self, url) -> SitemapStats:
+        """Return the SitemapStats for url, creating it if necessary"""
+        with self._lock:
+            stats = self._sitemaps.get(url)
+            if stats is None:
+                stats = SitemapStats(url)
+                self._sitemaps[url] = stats
+            return stats
+
+    def add(self, url, field, value):
+        stats = self.sitemap(url)
+        with self._lock:
+            setattr(stats, field, getattr(stats, field) + value)
+
+    @contextlib.contextmanager
+    def timer(self, url, field):
+        """Add the time spent in the with block to field"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(url, field, time.perf_counter() - t0)
+
+    def parsing(self, url, entries):
+        """
+        Yield from entries, counting them and adding the time spent
+        producing them to parse_seconds.
+
+        Fetch and decompress time recorded for url while iterating, as when
+        streaming, is not counted as parse time.
+        """
+        stats = self.sitemap(url)
+        before = stats.fetch_seconds + stats.decompress_seconds
+        elapsed = 0.0
+        n = 0
+        entries = iter(entries)
+        try:
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    entry = next(entries)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - t0
+                n += 1
+                yield entry
+        finally:
+            streamed = stats.fetch_seconds + stats.decompress_seconds - before
+            self.add(url, "parse_seconds", max(0.0, elapsed - streamed))
+            self.add(url, "entries", n)
+
+    @property
+    def sitemaps(self):
+        with self._lock:
+            return list(self._sitemaps.values())
+
+    def totals(self) -> SitemapStats:
+        """Return a SitemapStats summing every sitemap, with url None"""
+        total = SitemapStats(None)
+        for stats in self.sitemaps:
+            for f in SitemapStats.FIELDS:
+                setattr(total, f, getattr(total, f) + getattr(stats, f))
+        return total
+
+    def asJsonDict(self):
+        return {
+            "totals": self.totals().asJsonDict(),
+            "sitemaps": [s.asJsonDict() for s in self.sitemaps],
+        }
+
+    def writeJsonl(self, dest):
+        """Write a JSON line for each sitemap, then one with the totals"""
+        for stats in self.sitemaps:
+            dest.write(json.dumps(dict(kind="sitemap", **stats.asJsonDict())))
+            dest.write("\n")
+        totals = self.totals().asJsonDict()
+        totals["sitemaps"] = len(self._sitemaps)
+        dest.write(json.dumps(dict(kind="totals", **totals)))
+        dest.write("\n")
+
+    def __str__(self):
+        lines = [str(s) for s in self.sitemaps]
+        lines.append(f"Total of {len(lines)} sitemaps: " + str(self.totals()).split(": ", 1)[1])
+        return "\n".join(lines)
@@ -1,17 +1,83 @@
 import contextlib
+import datetime
+import logging
+import sqlalchemy
+import sqlalchemy.event
 import sqlalchemy.orm
 import sqlmodel
 from . import sitemap
+from . import writer
+from . import cache
 
 SitemapIndex = sitemap.SitemapIndex
 SitemapEntry = sitemap.SitemapEntry
+BatchWriter = writer.BatchWriter
+BatchResult = writer.BatchResult
+WriterThread = writer.WriterThread
+SitemapValidator = sitemap.SitemapValidator
+DatabaseValidatorCache = cache.DatabaseValidatorCache
+Crawl = sitemap.Crawl
+CrawlCheckpoint = sitemap.CrawlCheckpoint
 
+_L = logging.getLogger("models")
 
-def init_db(database_url):
+
+# Seconds a SQLite connection waits for a lock held by another connection
+SQLITE_BUSY_TIMEOUT = 30
+# SQLite page cache for bulk loads, negative values are KiB
+SQLITE_BULK_CACHE_SIZE = -65536
+
+
+def _sqlitePragmas(bulk_load):
+    def onConnect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers, such as recent and export, run during a load
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT * 1000}")
+        if bulk_load:
+            # With WAL, NORMAL only syncs at checkpoints and stays consistent
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute(f"PRAGMA cache_size={SQLITE_BULK_CACHE_SIZE}")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    return onConnect
+
+
+def init_db(database_url, bulk_load=False):
+    """Create the engine and tables for database_url.
+
+    SQLite databases use WAL journaling. With bulk_load, connections are
+    also tuned for loading: synchronous=NORMAL, a larger page cache and
+    in memory temporary storage.
+    """
     engine = sqlmodel.create_engine(database_url)
+    if engine.dialect.name == "sqlite":
+        sqlalchemy.event.listen(engine, "connect", _sqlitePragmas(bulk_load))
     sqlmodel.SQLModel.metadata.create_all(engine)
+    _addMissingColumns(engine)
     return engine
 
+
+def _addMissingColumns(engine):
+    """Add columns and indexes added to the models since the tables were created"""
+    inspector = sqlalchemy.inspect(engine)
+    for table in sqlmodel.SQLModel.metadata.sorted_tables:
+        present = set(c["name"] for c in inspector.get_columns(table.name))
+        missing = [c for c in table.columns if c.name not in present]
+        if missing:
+            with engine.begin() as conn:
+                for column in missing:
+                    _L.info("Adding column %s.%s", table.name, column.name)
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.exec_driver_sql(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                    )
+        # Indexes added to a table whose columns were already present
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
 @contextlib.contextmanager
 def get_session(engine):
     session = sqlmodel.Session(engine)
@@ -38,10 +104,195 @@ def getSitemapRoots(engine):
         return session.exec(statement).all()
 
 
-def changedSince(engine, dtlast):
+def getCrawlRoots(engine):
+    """Return the sorted root urls of previous crawls and sitemap indexes"""
+    roots = set(r[0] for r in getSitemapRoots(engine) if r[0] is not None)
+    with get_session(engine) as session:
+        roots.update(session.exec(sqlmodel.select(Crawl.root).distinct()).all())
+    return sorted(roots)
+
+
+def startCrawl(engine, root, resume=False) -> Crawl:
+    """Start a crawl of root, or continue the latest unfinished one if resume"""
+    with get_session(engine) as session:
+        crawl = None
+        if resume:
+            statement = (sqlmodel.select(Crawl)
+                         .where(Crawl.root == root)
+                         .where(Crawl.t_completed == None)  # noqa: E711
+                         .order_by(Crawl.id.desc()))
+            crawl = session.exec(statement).first()
+            if crawl is None:
+                _L.info("No unfinished crawl of %s to resume", root)
+        if crawl is None:
+            crawl = Crawl(
+                root=root, t_started=datetime.datetime.now(tz=datetime.timezone.utc)
+            )
+            session.add(crawl)
+            session.commit()
+            session.refresh(crawl)
+        session.expunge(crawl)
+        return crawl
+
+
+def finishCrawl(engine, crawl_id):
+    with get_session(engine) as session:
+        crawl = session.get(Crawl, crawl_id)
+        crawl.t_completed = datetime.datetime.now(tz=datetime.timezone.utc)
+        session.commit()
+
+
+def addCheckpoint(engine, crawl_id, loc, parsed=False, lastmod=None):
+    """Record that the sitemap at loc has been committed in crawl crawl_id
+
+    parsed is True if every entry of the sitemap was read, making its
+    entries eligible for removal by sweepRemoved. lastmod is the value
+    listed for the sitemap by its sitemapindex, if any.
+    """
+    with get_session(engine) as session:
+        session.merge(CrawlCheckpoint(
+            crawl_id=crawl_id,
+            loc=loc,
+            parsed=parsed,
+            lastmod=lastmod,
+            t_completed=datetime.datetime.now(tz=datetime.timezone.utc),
+        ))
+        session.commit()
+
+
+def crawlCheckpoints(engine, crawl_id):
+    """Return the set of sitemap urls fully parsed and committed in crawl crawl_id
+
+    Sitemaps that failed to load or were only partly read are not included,
+    so a resumed crawl fetches them again.
+    """
+    with get_session(engine) as session:
+        statement = (sqlmodel.select(CrawlCheckpoint.loc)
+                     .where(CrawlCheckpoint.crawl_id == crawl_id)
+                     .where(CrawlCheckpoint.parsed == True))  # noqa: E712
+        return set(session.exec(statement).all())
+
+
+def sweepRemoved(engine, crawl_id):
+    """Mark entries of the sitemaps parsed in crawl crawl_id that it did not see.
+
+    For each parsed sitemap, one UPDATE sets t_removed on the SitemapIndex
+    and SitemapEntry rows with that source and an older generation.
+    Returns a dict of table name to the number of rows marked removed.
+    """
+    with get_session(engine) as session:
+        statement = (sqlmodel.select(CrawlCheckpoint.loc)
+                     .where(CrawlCheckpoint.crawl_id == crawl_id)
+                     .where(CrawlCheckpoint.parsed == True))  # noqa: E712
+        sources = session.exec(statement).all()
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    removed = {}
+    with engine.begin() as conn:
+        for model in (SitemapIndex, SitemapEntry):
+            table = model.__table__
+            removed[table.name] = 0
+            for source in sources:
+                result = conn.execute(
+                    sqlalchemy.update(table)
+                    .where(table.c.source == source)
+                    .where(table.c.t_removed == None)  # noqa: E711
+                    .where(sqlalchemy.or_(
+                        table.c.generation == None,  # noqa: E711
+                        table.c.generation < crawl_id,
+                    ))
+                    .values(t_removed=now, t_updated=now)
+                )
+                removed[table.name] += result.rowcount
+    _L.info("Crawl %s removed %s", crawl_id, removed)
+    return removed
+
+
+def sitemapLastmods(engine):
+    """Return a dict of child sitemap loc to the lastmod it was last parsed at
+
+    The lastmod is that listed by the sitemapindex when the sitemap was most
+    recently fully parsed. Sitemaps that failed, were only partly read or
+    were never reached are not included, so an incremental load fetches
+    them again.
+    """
+    with get_session(engine) as session:
+        statement = (sqlmodel.select(CrawlCheckpoint.loc, CrawlCheckpoint.lastmod)
+                     .where(CrawlCheckpoint.parsed == True)  # noqa: E712
+                     .order_by(CrawlCheckpoint.t_completed))
+        return {loc: lastmod for loc, lastmod in session.exec(statement)}
+
+
+# Rows fetched from the database cursor at a time
+DEFAULT_PAGE_SIZE = 1000
+
+
+def changedSince(engine, dtlast, yield_per=DEFAULT_PAGE_SIZE, include_removed=False):
+    """Yield entries with lastmod > dtlast, most recent first.
+
+    Entries marked removed are excluded, unless include_removed is True in
+    which case entries removed after dtlast are also yielded, with
+    t_removed set.
+
+    Rows are fetched yield_per at a time rather than all at once.
+    """
+    if include_removed:
+        condition = sqlalchemy.or_(SitemapEntry.lastmod > dtlast,
+                                   SitemapEntry.t_removed > dtlast)
+    else:
+        condition = sqlalchemy.and_(SitemapEntry.lastmod > dtlast,
+                                    SitemapEntry.t_removed == None)  # noqa: E711
     with get_session(engine) as session:
         statement = (sqlmodel.select(SitemapEntry)
-                     .where(SitemapEntry.lastmod > dtlast)
-                     .order_by(SitemapEntry.lastmod.desc()))
+                     .where(condition)
+                     .order_by(SitemapEntry.lastmod.desc(), SitemapEntry.loc.desc())
+                     .execution_options(yield_per=yield_per))
         for entry in session.exec(statement):
             yield entry
+
+
+def changedSincePage(engine, dtlast, after=None, limit=DEFAULT_PAGE_SIZE):
+    """Return a page of entries with lastmod > dtlast, ordered by (lastmod, loc).
+
+    Entries marked removed are excluded.
+
+    Args:
+        engine: SQLAlchemy engine
+        dtlast: Return entries modified after this time
+        after: Cursor returned with the previous page, or None for the first
+        limit: Maximum number of entries in the page
+
+    Returns:
+        (entries, cursor), where cursor is passed as after to get the next
+        page and is None when there are no more entries. The entries are
+        detached from the session.
+    """
+    with get_session(engine) as session:
+        statement = (sqlmodel.select(SitemapEntry)
+                     .where(SitemapEntry.lastmod > dtlast)
+                     .where(SitemapEntry.t_removed == None))  # noqa: E711
+        if after is not None:
+            lastmod, loc = after
+            statement = statement.where(sqlalchemy.or_(
+                SitemapEntry.lastmod > lastmod,
+                sqlalchemy.and_(SitemapEntry.lastmod == lastmod,
+                                SitemapEntry.loc > loc),
+            ))
+        statement = (statement
+                     .order_by(SitemapEntry.lastmod, SitemapEntry.loc)
+                     .limit(limit))
+        entries = session.exec(statement).all()
+        session.expunge_all()
+    cursor = None
+    if len(entries) == limit:
+        cursor = (entries[-1].lastmod, entries[-1].loc)
+    return entries, cursor
+
+
+def iterChangedSince(engine, dtlast, page_size=DEFAULT_PAGE_SIZE, after=None):
+    """Yield entries with lastmod > dtlast, oldest first, one page at a time"""
+    while True:
+        entries, after = changedSincePage(engine, dtlast, after=after, limit=page_size)
+        for entry in entries:
+            yield entry
+        if after is None:
+            break
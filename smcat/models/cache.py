@@ -0,0 +1,47 @@
+"""
+Database backed store of HTTP validators for conditional sitemap requests.
+"""
+import logging
+import sqlmodel
+import smcat.sitemap
+from . import sitemap
+
+_L = logging.getLogger("models.cache")
+
+
+class DatabaseValidatorCache(smcat.sitemap.ValidatorCache):
+    """
+    ValidatorCache persisted in the SitemapValidator table.
+
+    Stored validators are read once when created. New validators are kept
+    in memory until commit() is called, which should happen only after the
+    entries of the crawl have been written so an interrupted load does not
+    leave validators for sitemaps that were not saved.
+    """
+
+    def __init__(self, engine):
+        super().__init__()
+        self.engine = engine
+        self._pending = {}
+        with sqlmodel.Session(engine) as session:
+            for row in session.query(sitemap.SitemapValidator):
+                self._validators[row.url] = (row.etag, row.last_modified)
+        _L.debug("Loaded %s validators", len(self._validators))
+
+    def put(self, url, etag, last_modified):
+        super().put(url, etag, last_modified)
+        self._pending[url] = (etag, last_modified)
+
+    def commit(self):
+        if not self._pending:
+            return
+        with sqlmodel.Session(self.engine) as session:
+            for url, (etag, last_modified) in self._pending.items():
+                session.merge(
+                    sitemap.SitemapValidator(
+                        url=url, etag=etag, last_modified=last_modified
+                    )
+                )
+            session.commit()
+        _L.debug("Saved %s validators", len(self._pending))
+        self._pending = {}
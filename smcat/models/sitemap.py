@@ -40,6 +40,7 @@ class SitemapBase(sqlmodel.SQLModel):
         sa_column=sqlalchemy.Column(
             sqlalchemy.DateTime(timezone=True),
             default=None,
+            index=True,
             doc="Date time lastmod entry from loc, if present",
         )
     )
@@ -51,6 +52,32 @@ class SitemapBase(sqlmodel.SQLModel):
         )
     )
 
+    fingerprint: typing.Optional[int] = sqlmodel.Field(
+        default=None,
+        sa_column=sqlalchemy.Column(
+            sqlalchemy.BigInteger,
+            nullable=True,
+            doc="Hash of loc and the entry values, to detect changes",
+        )
+    )
+
+    generation: typing.Optional[int] = sqlmodel.Field(
+        default=None,
+        nullable=True,
+        index=True,
+        description="Id of the last crawl that saw this entry",
+    )
+
+    t_removed: typing.Optional[datetime.datetime] = sqlmodel.Field(
+        default=None,
+        sa_column=sqlalchemy.Column(
+            sqlalchemy.DateTime(timezone=True),
+            nullable=True,
+            index=True,
+            doc="Timestamp for when the entry disappeared from its source, None if present",
+        )
+    )
+
     def asJsonDict(self) -> typing.Dict:
         res = {
             "loc": self.loc,
@@ -60,6 +87,10 @@ class SitemapBase(sqlmodel.SQLModel):
             "t_created": self.t_created.isoformat(),
             "t_updated": self.t_updated.isoformat(),
             "properties": self.properties,
+            "generation": self.generation,
+            "t_removed": self.t_removed
+            if self.t_removed is None
+            else self.t_removed.isoformat(),
         }
         return res
 
@@ -73,18 +104,22 @@ class SitemapBase(sqlmodel.SQLModel):
 class SitemapIndex(SitemapBase, table=True):
 
     source: typing.Optional[str] = sqlmodel.Field(
-        default=None, foreign_key="sitemapindex.loc"
+        default=None, foreign_key="sitemapindex.loc", index=True
     )
 
 
 class SitemapEntry(SitemapBase, table=True):
 
+    __table_args__ = (
+        sqlalchemy.Index("ix_sitemapentry_source_lastmod", "source", "lastmod"),
+    )
+
     priority: float = sqlmodel.Field(
         default=None, nullable=True, description="loc priority entry"
     )
 
     source: typing.Optional[str] = sqlmodel.Field(
-        default=None, foreign_key="sitemapindex.loc"
+        default=None, foreign_key="sitemapindex.loc", index=True
     )
 
     changefreq: str = sqlmodel.Field(
@@ -100,3 +135,81 @@ class SitemapEntry(SitemapBase, table=True):
         res["changefreq"] = self.changefreq
         return res
 
+
+
+class SitemapValidator(sqlmodel.SQLModel, table=True):
+    """HTTP validators from the last successful fetch of a sitemap url"""
+
+    url: str = sqlmodel.Field(
+        primary_key=True,
+        nullable=False,
+        description="Requested url of a sitemap document",
+    )
+
+    etag: typing.Optional[str] = sqlmodel.Field(
+        default=None, nullable=True, description="ETag response header"
+    )
+
+    last_modified: typing.Optional[str] = sqlmodel.Field(
+        default=None, nullable=True, description="Last-Modified response header"
+    )
+
+
+class Crawl(sqlmodel.SQLModel, table=True):
+    """A run of loading the sitemaps below root. The id is the crawl generation."""
+
+    id: typing.Optional[int] = sqlmodel.Field(default=None, primary_key=True)
+
+    root: str = sqlmodel.Field(
+        index=True, nullable=False, description="Root sitemap url of the crawl"
+    )
+
+    t_started: datetime.datetime = sqlmodel.Field(
+        sa_column=sqlalchemy.Column(
+            sqlalchemy.DateTime(timezone=True),
+            nullable=False,
+            doc="Timestamp for when the crawl started",
+        )
+    )
+
+    t_completed: typing.Optional[datetime.datetime] = sqlmodel.Field(
+        default=None,
+        sa_column=sqlalchemy.Column(
+            sqlalchemy.DateTime(timezone=True),
+            nullable=True,
+            doc="Timestamp for when the crawl finished, None if interrupted",
+        )
+    )
+
+
+class CrawlCheckpoint(sqlmodel.SQLModel, table=True):
+    """A sitemap document fully fetched, parsed and committed during a crawl"""
+
+    crawl_id: int = sqlmodel.Field(primary_key=True, foreign_key="crawl.id")
+
+    loc: str = sqlmodel.Field(
+        primary_key=True, nullable=False, description="Url of the sitemap document"
+    )
+
+    parsed: bool = sqlmodel.Field(
+        default=False,
+        nullable=False,
+        description="True if every entry of the document was read",
+    )
+
+    t_completed: datetime.datetime = sqlmodel.Field(
+        sa_column=sqlalchemy.Column(
+            sqlalchemy.DateTime(timezone=True),
+            nullable=False,
+            doc="Timestamp for when the sitemap was committed",
+        )
+    )
+
+    lastmod: typing.Optional[datetime.datetime] = sqlmodel.Field(
+        default=None,
+        sa_column=sqlalchemy.Column(
+            sqlalchemy.DateTime(timezone=True),
+            nullable=True,
+            doc="Lastmod listed for the sitemap by its sitemapindex, if any",
+        ),
+    )
@@ -0,0 +1,485 @@
+"""
+Batched writer for sitemap entries.
+
+Entries are buffered in memory and written with a single
+INSERT ... ON CONFLICT (loc) DO UPDATE statement per batch on
+SQLite and PostgreSQL. Other dialects fall back to session.merge.
+
+Each row carries a fingerprint, a 64 bit hash of its loc and values.
+Rows whose stored fingerprint matches are not rewritten, so t_updated
+records when an entry actually changed.
+
+A url that appears more than once in a load is written once, with the
+values of the occurrence with the newest lastmod. Urls are remembered as
+64 bit hashes in a KeySet, at most 24 bytes each, and lastmod is only kept
+in memory for urls seen more than once.
+
+When a crawl generation is given, every row written or seen unchanged is
+stamped with it, so rows missing from a later crawl can be swept as removed.
+"""
+import array
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import queue
+import threading
+import time
+import sqlalchemy
+import sqlalchemy.dialects.postgresql
+import sqlalchemy.dialects.sqlite
+import sqlmodel
+from . import sitemap
+
+_L = logging.getLogger("models.writer")
+
+# Keep IN (...) lists below the SQLite bound parameter limit
+_SELECT_CHUNK = 500
+
+
+def _fingerprintValue(v):
+    if v is None:
+        return b"\0"
+    if isinstance(v, datetime.datetime):
+        return v.isoformat().encode("utf-8")
+    if isinstance(v, dict):
+        return json.dumps(v, sort_keys=True, default=str).encode("utf-8")
+    return str(v).encode("utf-8")
+
+
+def fingerprint(row, columns):
+    """Return a signed 64 bit hash of the loc and columns values of row"""
+    h = hashlib.blake2b(row["loc"].encode("utf-8"), digest_size=8)
+    for c in columns:
+        h.update(b"\x1f")
+        h.update(_fingerprintValue(row.get(c)))
+    return int.from_bytes(h.digest(), "little", signed=True)
+
+
+def _isNewer(a, b):
+    """True if lastmod a should replace lastmod b"""
+    if a is None:
+        return False
+    if b is None:
+        return True
+    if a.tzinfo is None or b.tzinfo is None:
+        return a.replace(tzinfo=None) > b.replace(tzinfo=None)
+    return a > b
+
+
+def _locKey(loc):
+    """Compact 64 bit key for loc, used to find duplicates within a load"""
+    return int.from_bytes(
+        hashlib.blake2b(loc.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+class KeySet(object):
+    """
+    Compact set of unsigned 64 bit integers, such as hashes from _locKey.
+
+    Keys are stored in a packed array used as an open addressing hash
+    table, which is doubled in size when two thirds full. Each key takes
+    8 to 24 bytes, against over 100 for an int in a Python set. Key 0 is
+    stored as 1, keys are expected to be uniformly distributed hashes.
+
+    Args:
+        capacity: Initial number of slots, a power of two
+    """
+
+    def __init__(self, capacity=65536):
+        self._table = array.array("Q", bytes(8 * capacity))
+        self._mask = capacity - 1
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        key = key or 1
+        table = self._table
+        i = key & self._mask
+        while table[i]:
+            if table[i] == key:
+                return True
+            i = (i + 1) & self._mask
+        return False
+
+    def add(self, key):
+        """Add key, returning False if it was already present"""
+        key = key or 1
+        table = self._table
+        mask = self._mask
+        i = key & mask
+        k = table[i]
+        while k:
+            if k == key:
+                return False
+            i = (i + 1) & mask
+            k = table[i]
+        table[i] = key
+        self._size += 1
+        if 3 * self._size > 2 * len(table):
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self._table
+        table = self._table = array.array("Q", bytes(16 * len(old)))
+        mask = self._mask = len(table) - 1
+        for key in old:
+            if key:
+                i = key & mask
+                while table[i]:
+                    i = (i + 1) & mask
+                table[i] = key
+
+
+def _toFloat(v):
+    if v is None or v == "":
+        return None
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def _toDatetime(v):
+    if isinstance(v, datetime.datetime):
+        return v
+    return None
+
+
+class BatchResult(object):
+    """Counts of rows inserted, updated and unchanged by a batch."""
+
+    def __init__(self, table, inserted=0, updated=0, unchanged=0):
+        self.table = table
+        self.inserted = inserted
+        self.updated = updated
+        self.unchanged = unchanged
+
+    @property
+    def total(self):
+        return self.inserted + self.updated + self.unchanged
+
+    def add(self, other):
+        self.inserted += other.inserted
+        self.updated += other.updated
+        self.unchanged += other.unchanged
+
+    def asJsonDict(self):
+        return {
+            "table": self.table,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "unchanged": self.unchanged,
+        }
+
+    def __str__(self):
+        return (
+            f"{self.table}: inserted={self.inserted} "
+            f"updated={self.updated} unchanged={self.unchanged}"
+        )
+
+
+class BatchWriter(object):
+    """
+    Buffers SitemapIndex and SitemapEntry rows and upserts them in batches.
+
+    Args:
+        engine: SQLAlchemy engine
+        batch_size: Number of buffered entries that triggers a flush
+        on_batch: Optional callable, called with a BatchResult after each
+          batch is written
+        generation: Optional crawl id stamped on each row. Rows previously
+          marked removed are restored when seen again.
+        stats: Optional smcat.metrics.CrawlStats. The time to write each
+          batch is added to flush_seconds of the source sitemaps of its rows,
+          in proportion to their number of rows.
+    """
+
+    # Columns written and fingerprinted to decide if a row has changed
+    INDEX_COLUMNS = ("lastmod", "source", "properties")
+    ENTRY_COLUMNS = ("lastmod", "priority", "changefreq", "source", "properties")
+
+    def __init__(
+        self, engine, batch_size=1000, on_batch=None, generation=None, stats=None
+    ):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.on_batch = on_batch
+        self.generation = generation
+        self.stats = stats
+        # Hashed loc of every entry added, for merging duplicates. lastmod is
+        # kept for hashes seen more than once, when not known it is read from
+        # the database for the locs in _resolve.
+        self._seen = KeySet()
+        self._lastmods = {}
+        self._resolve = set()
+        self.duplicates = 0
+        # Time spent writing batches to the database
+        self.flush_seconds = 0.0
+        self.dialect = engine.dialect.name
+        self._indexes = {}
+        self._entries = {}
+        self.totals = {
+            sitemap.SitemapIndex.__tablename__: BatchResult(
+                sitemap.SitemapIndex.__tablename__
+            ),
+            sitemap.SitemapEntry.__tablename__: BatchResult(
+                sitemap.SitemapEntry.__tablename__
+            ),
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    def addIndex(self, loc, lastmod=None, source=None, properties=None):
+        self._indexes[loc] = {
+            "loc": loc,
+            "lastmod": _toDatetime(lastmod),
+            "source": source,
+            "properties": properties or None,
+        }
+        if len(self._indexes) >= self.batch_size:
+            self._flushTable(sitemap.SitemapIndex, self._indexes, self.INDEX_COLUMNS)
+            self._indexes = {}
+
+    def addEntry(
+        self,
+        loc,
+        lastmod=None,
+        priority=None,
+        changefreq=None,
+        source=None,
+        properties=None,
+    ):
+        """
+        Buffer an entry. If loc was already added to this writer, the entry is
+        kept only if its lastmod is newer, replacing the earlier one.
+        """
+        lastmod = _toDatetime(lastmod)
+        key = _locKey(loc)
+        if not self._seen.add(key):
+            self.duplicates += 1
+            pending = self._entries.get(loc)
+            if pending is not None:
+                if not _isNewer(lastmod, pending["lastmod"]):
+                    return
+                self._lastmods[key] = lastmod
+            elif key in self._lastmods:
+                if not _isNewer(lastmod, self._lastmods[key]):
+                    return
+                self._lastmods[key] = lastmod
+            else:
+                # The earlier entry has been written, compare when flushed
+                self._resolve.add(loc)
+        self._entries[loc] = {
+            "loc": loc,
+            "lastmod": lastmod,
+            "priority": _toFloat(priority),
+            "changefreq": changefreq if changefreq else None,
+            "source": source,
+            "properties": properties or None,
+        }
+        if len(self._entries) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # Index rows first, entries reference them through source
+        if self._indexes:
+            self._flushTable(sitemap.SitemapIndex, self._indexes, self.INDEX_COLUMNS)
+            self._indexes = {}
+        if self._entries:
+            self._flushTable(
+                sitemap.SitemapEntry,
+                self._entries,
+                self.ENTRY_COLUMNS,
+                resolve=self._resolve,
+            )
+            self._entries = {}
+            self._resolve = set()
+
+    def _existing(self, conn, table, locs):
+        cols = [
+            table.c.loc,
+            table.c.fingerprint,
+            table.c.generation,
+            table.c.t_removed,
+            table.c.lastmod,
+        ]
+        existing = {}
+        for i in range(0, len(locs), _SELECT_CHUNK):
+            chunk = locs[i : i + _SELECT_CHUNK]
+            for row in conn.execute(sqlalchemy.select(*cols).where(table.c.loc.in_(chunk))):
+                existing[row[0]] = row
+        return existing
+
+    def _upsertStatement(self, table, columns):
+        if self.dialect == "sqlite":
+            stmt = sqlalchemy.dialects.sqlite.insert(table)
+        elif self.dialect == "postgresql":
+            stmt = sqlalchemy.dialects.postgresql.insert(table)
+        else:
+            return None
+        update = {c: stmt.excluded[c] for c in columns}
+        update["fingerprint"] = stmt.excluded.fingerprint
+        update["t_updated"] = stmt.excluded.t_updated
+        if self.generation is not None:
+            # Concurrent crawls may overlap, never lower the generation
+            update["generation"] = sqlalchemy.case(
+                (table.c.generation > stmt.excluded.generation, table.c.generation),
+                else_=stmt.excluded.generation,
+            )
+            update["t_removed"] = stmt.excluded.t_removed
+        return stmt.on_conflict_do_update(index_elements=[table.c.loc], set_=update)
+
+    def _flushTable(self, model, rows, columns, resolve=()):
+        """
+        Write rows, a dict of loc to row, skipping unchanged rows. Rows with
+        a loc in resolve repeat one written earlier in the load and are only
+        written if their lastmod is newer than the stored one.
+        """
+        table = model.__table__
+        result = BatchResult(table.name)
+        t0 = time.perf_counter()
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        with self.engine.begin() as conn:
+            existing = self._existing(conn, table, list(rows.keys()))
+            changed = []
+            unstamped = []
+            for loc, row in rows.items():
+                current = existing.get(loc)
+                if loc in resolve and current is not None:
+                    if not _isNewer(row["lastmod"], current.lastmod):
+                        self._lastmods[_locKey(loc)] = current.lastmod
+                        continue
+                    self._lastmods[_locKey(loc)] = row["lastmod"]
+                row["fingerprint"] = fingerprint(row, columns)
+                if current is None:
+                    result.inserted += 1
+                elif current.fingerprint == row["fingerprint"] and current.t_removed is None:
+                    result.unchanged += 1
+                    if self.generation is not None and (
+                        current.generation is None or current.generation < self.generation
+                    ):
+                        unstamped.append(loc)
+                    continue
+                else:
+                    result.updated += 1
+                row["t_created"] = now
+                row["t_updated"] = now
+                if self.generation is not None:
+                    row["generation"] = self.generation
+                    row["t_removed"] = None
+                changed.append(row)
+            if changed:
+                stmt = self._upsertStatement(table, columns)
+                if stmt is not None:
+                    conn.execute(stmt, changed)
+                else:
+                    self._mergeRows(conn, model, changed)
+            if unstamped:
+                self._stampGeneration(conn, table, unstamped)
+        elapsed = time.perf_counter() - t0
+        self.flush_seconds += elapsed
+        if self.stats is not None:
+            sources = collections.Counter(row["source"] for row in rows.values())
+            for source, n in sources.items():
+                if source is not None:
+                    self.stats.add(source, "flush_seconds", elapsed * n / len(rows))
+        self.totals[table.name].add(result)
+        _L.info("Batch %s", result)
+        if self.on_batch is not None:
+            self.on_batch(result)
+        return result
+
+    def _stampGeneration(self, conn, table, locs):
+        for i in range(0, len(locs), _SELECT_CHUNK):
+            conn.execute(
+                sqlalchemy.update(table)
+                .where(table.c.loc.in_(locs[i : i + _SELECT_CHUNK]))
+                .where(sqlalchemy.or_(
+                    table.c.generation == None,  # noqa: E711
+                    table.c.generation < self.generation,
+                ))
+                # Keep t_updated, the row itself has not changed
+                .values(generation=self.generation, t_updated=table.c.t_updated)
+            )
+
+    def _mergeRows(self, conn, model, rows):
+        with sqlmodel.Session(bind=conn) as session:
+            for row in rows:
+                existing = session.get(model, row["loc"])
+                if existing is not None:
+                    row.pop("t_created", None)
+                    for k, v in row.items():
+                        setattr(existing, k, v)
+                else:
+                    session.add(model(**row))
+            session.flush()
+
+
+class WriterThread(object):
+    """
+    Runs database writes in a dedicated thread fed by a bounded queue, so
+    the thread producing entries does not wait on disk.
+
+    Calls are made in the order submitted. An exception in the writer
+    thread is raised by the next submit() or by close().
+
+    Args:
+        maxsize: Maximum number of calls waiting in the queue
+    """
+
+    def __init__(self, maxsize=10000):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._failed = False
+        self._thread = threading.Thread(target=self._run, name="writer", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+        while True:
+            call = self._queue.get()
+            if call is None:
+                break
+            if self._failed:
+                # Drain after a failure so submit() does not block
+                continue
+            fn, args, kwargs = call
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                _L.exception("Writer thread failed")
+                self._error = e
+                self._failed = True
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) in the writer thread"""
+        self._raise()
+        self._queue.put((fn, args, kwargs))
+
+    def close(self):
+        """Wait for submitted calls to complete"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise()
@@ -10,14 +10,21 @@ It needs to be modified to emit each type of thing encountered instead of just t
 """
 import datetime
 import types
+import typing
 import logging
 import re
-import struct
-import io
-import gzip
+import collections
+import itertools
+import concurrent.futures
+import multiprocessing
+import threading
+import zlib
 import urllib.parse
 import lxml.etree
+import time
 import requests
+import smcat.metrics
+import smcat.transport
 import functools
 import dateutil.parser
 
@@ -35,10 +42,130 @@ SM_LASTMOD = "{http://www.sitemaps.org/schemas/sitemap/0.9}lastmod"
 SM_PRIORITY = "{http://www.sitemaps.org/schemas/sitemap/0.9}priority"
 SM_CHANGEFREQ = "{http://www.sitemaps.org/schemas/sitemap/0.9}changefreq"
 
+# Sitemap extension elements
+SM_IMAGE = "{http://www.google.com/schemas/sitemap-image/1.1}image"
+SM_NEWS = "{http://www.google.com/schemas/sitemap-news/0.9}news"
+SM_VIDEO = "{http://www.google.com/schemas/sitemap-video/1.1}video"
+SM_XHTML_LINK = "{http://www.w3.org/1999/xhtml}link"
 
-@functools.cache
-def _toDatetimeTZ(V):
-    return dateutil.parser.isoparse(V)
+GZIP_MAGIC = b"\x1f\x8b\x08"
+GZIP_TRAILER_SIZE = 8
+STREAM_CHUNK_SIZE = 65536
+# Bytes kept from the end of a document to check that its root is closed
+DOCUMENT_TAIL_SIZE = 1024
+
+# Tasks that require fetching another sitemap document
+FETCH_TASKS = ("sitemapindex", "robotsitemap")
+
+# Levels of child sitemaps followed below the root sitemap
+DEFAULT_MAX_DEPTH = 10
+# Sitemap urls remembered to avoid fetching a sitemap twice
+DEFAULT_MAX_SITEMAPS = 100000
+
+
+class SitemapRecord(typing.NamedTuple):
+    """
+    Compact representation of a single sitemap or url entry.
+
+    kind is "sitemap" for entries of a sitemapindex and "url" for entries
+    of a urlset. extras is a dict of any other child elements, keyed and
+    valued as in the dictionaries yielded by SiteMapIterator, or None.
+    Extension elements such as images and news are stored by the database
+    writer as the properties of the entry.
+    """
+
+    kind: str
+    loc: str
+    lastmod: typing.Any = None
+    priority: typing.Optional[str] = None
+    changefreq: typing.Optional[str] = None
+    source: typing.Optional[str] = None
+    extras: typing.Optional[dict] = None
+
+    def asItem(self):
+        """Return the entry in the dictionary form yielded by SiteMap.__iter__"""
+        url = {SM_LOC: self.loc, SM_LASTMOD: self.lastmod}
+        if self.priority is not None:
+            url[SM_PRIORITY] = self.priority
+        if self.changefreq is not None:
+            url[SM_CHANGEFREQ] = self.changefreq
+        if self.extras is not None:
+            url.update(self.extras)
+        return {"kind": self.kind, "url": url, "source": self.source}
+
+    @classmethod
+    def fromItem(cls, item):
+        """Create a record from an item yielded by SiteMap.__iter__"""
+        url = dict(item["url"])
+        return cls(
+            item["kind"],
+            url.pop(SM_LOC),
+            url.pop(SM_LASTMOD, None),
+            url.pop(SM_PRIORITY, None),
+            url.pop(SM_CHANGEFREQ, None),
+            item.get("source"),
+            url or None,
+        )
+
+
+# Number of distinct lastmod strings remembered by parseW3CDatetime
+LASTMOD_CACHE_SIZE = 4096
+
+# Year or year-month, which datetime.fromisoformat does not accept
+_W3C_YEAR_MONTH = re.compile(r"^(\d{4})(?:-(\d{2}))?$")
+
+
+@functools.lru_cache(maxsize=LASTMOD_CACHE_SIZE)
+def parseW3CDatetime(value):
+    """
+    Parse a W3C datetime (https://www.w3.org/TR/NOTE-datetime) string.
+
+    The formats allowed by the sitemap protocol are handled with
+    datetime.fromisoformat, falling back to dateutil for anything else.
+    Raises ValueError if value can not be parsed.
+    """
+    v = value.strip()
+    if v[-1:] in ("Z", "z"):
+        v = v[:-1] + "+00:00"
+    try:
+        return datetime.datetime.fromisoformat(v)
+    except ValueError:
+        pass
+    m = _W3C_YEAR_MONTH.match(v)
+    if m is not None:
+        return datetime.datetime(int(m.group(1)), int(m.group(2) or 1), 1)
+    return dateutil.parser.isoparse(value)
+
+
+def parseLastmod(value):
+    """Return value parsed as a datetime, or unchanged if that fails"""
+    if not value or isinstance(value, datetime.datetime):
+        return value
+    try:
+        return parseW3CDatetime(value)
+    except (ValueError, TypeError, OverflowError):
+        L.debug("Failed to parse %s", value)
+        return value
+
+
+def isLastmodFailure(value):
+    """True if value is a lastmod string that could not be parsed"""
+    return isinstance(value, str) and value != ""
+
+
+def isNewer(lastmod, stored):
+    """
+    True if lastmod is later than stored, or if either is not a datetime.
+
+    Naive values (as read back from SQLite) are compared by wall time.
+    """
+    if not isinstance(lastmod, datetime.datetime) or not isinstance(
+        stored, datetime.datetime
+    ):
+        return True
+    if lastmod.tzinfo is None or stored.tzinfo is None:
+        return lastmod.replace(tzinfo=None) > stored.replace(tzinfo=None)
+    return lastmod > stored
 
 
 # @deprecated('GzipFile.read1')
@@ -46,34 +173,195 @@ def read1(gzf, size=-1):
     return gzf.read1(size)
 
 
-def gunzip(data):
+def gunzip(data, on_truncated=None):
     """Gunzip the given data and return as much data as possible.
-    This is resilient to CRC checksum errors.
+    This is resilient to truncated data and CRC checksum errors.
+    on_truncated is called if the data was incomplete or damaged.
     """
-    f = gzip.GzipFile(fileobj=io.BytesIO(data))
-    output_list = []
-    chunk = b"."
-    while chunk:
-        try:
-            chunk = f.read1(8196)
-            output_list.append(chunk)
-        except (IOError, EOFError, struct.error):
-            # complete only if there is some data, otherwise re-raise
-            # see issue 87 about catching struct.error
-            # some pages are quite small so output_list is empty and f.extrabuf
-            # contains the whole page content
-            if output_list or getattr(f, "extrabuf", None):
-                try:
-                    output_list.append(f.extrabuf[-f.extrasize :])
-                finally:
-                    break
-            else:
-                raise
-    return b"".join(output_list)
+    return b"".join(gunzipChunks(bodyChunks(data), on_truncated=on_truncated))
+
+
+def bodyChunks(data, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield data in chunks of up to chunk_size bytes without copying it"""
+    view = memoryview(data)
+    for i in range(0, len(view), chunk_size):
+        yield view[i : i + chunk_size]
 
 
 def gzipMagicNumber(response):
-    return response.content[:3] == b"\x1f\x8b\x08"
+    return response.content[:3] == GZIP_MAGIC
+
+
+def gunzipChunks(chunks, on_truncated=None):
+    """Incrementally gunzip an iterator of byte chunks.
+
+    Like gunzip, this returns as much data as possible from truncated
+    streams or streams with a bad CRC. If provided, on_truncated is called
+    with no arguments when that happens.
+    """
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    produced = False
+    started = False  # d has been given data of a gzip member
+    # Hold back the trailer so a bad CRC is only seen after all data is out
+    held = b""
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is None:
+            data, held = held, b""
+        else:
+            data = held + chunk
+            held = data[-GZIP_TRAILER_SIZE:]
+            data = data[:-GZIP_TRAILER_SIZE]
+        while data:
+            started = True
+            try:
+                out = d.decompress(data)
+            except zlib.error as e:
+                if produced:
+                    L.debug("Ignoring gzip error after partial output: %s", e)
+                    if on_truncated is not None:
+                        on_truncated()
+                    return
+                raise
+            if out:
+                produced = True
+                yield out
+            data = b""
+            if d.eof:
+                # Concatenated gzip members
+                data = d.unused_data
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                started = False
+    out = d.flush()
+    if out:
+        yield out
+    if started and not d.eof:
+        L.debug("Gzip stream ended before the end of its data")
+        if on_truncated is not None:
+            on_truncated()
+
+
+def rootClosed(tail, root_tag):
+    """
+    True if tail, the end of an XML document, closes the root element
+    root_tag. Only whitespace and comments may follow the end tag.
+    """
+    if tail is None:
+        return True
+    if isinstance(tail, str):
+        tail = tail.encode("utf-8")
+    pattern = (
+        rb"</(?:[^\s<>:]+:)?"
+        + re.escape(_localName(root_tag).encode("utf-8"))
+        + rb"\s*>\s*(?:<!--.*?-->\s*)*\Z"
+    )
+    return re.search(pattern, tail[-DOCUMENT_TAIL_SIZE:], re.S) is not None
+
+
+class ResponseStream(object):
+    """
+    Read only file-like view of a streamed response body.
+
+    The body is read from the socket in chunks and gunzipped on the fly
+    when it starts with the gzip magic number. If stats is provided, bytes
+    read, read time and decompress time are added to it on close. reads is
+    False when the body of response has already been downloaded, in which
+    case only decompress time is recorded.
+
+    truncated is set if a gzipped body could not be fully decompressed,
+    and tail holds the last bytes read for checking the document is complete.
+
+    release, if provided, is called once on close, as to free the host slot
+    held while the body is read.
+    """
+
+    def __init__(
+        self,
+        response,
+        chunk_size=STREAM_CHUNK_SIZE,
+        stats=None,
+        reads=True,
+        release=None,
+    ):
+        self.url = response.url
+        self._response = response
+        self._stats = stats
+        self._reads = reads
+        self._release = release
+        self.bytes = 0
+        self.read_seconds = 0.0
+        self.decompress_seconds = 0.0
+        self.truncated = False
+        self.tail = b""
+        chunks = self._timed(response.iter_content(chunk_size))
+        first = b""
+        for first in chunks:
+            if first:
+                break
+        self.gzipped = first[:3] == GZIP_MAGIC
+        self._chunks = self._chain(first, chunks)
+        if self.gzipped:
+            self._chunks = gunzipChunks(self._chunks, on_truncated=self._truncated)
+        self._buffer = b""
+        self._eof = False
+
+    def _truncated(self):
+        L.warning("Incomplete gzip body: %s", self.url)
+        self.truncated = True
+
+    @staticmethod
+    def _chain(first, chunks):
+        if first:
+            yield first
+        yield from chunks
+
+    def _timed(self, chunks):
+        """Yield chunks, counting bytes and time spent reading them"""
+        while True:
+            t0 = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                self.read_seconds += time.perf_counter() - t0
+            self.bytes += len(chunk)
+            yield chunk
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            t0 = time.perf_counter()
+            read_seconds = self.read_seconds
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                self._eof = True
+            if self.gzipped:
+                self.decompress_seconds += (
+                    time.perf_counter() - t0 - (self.read_seconds - read_seconds)
+                )
+        if size < 0 or size >= len(self._buffer):
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        if data:
+            self.tail = (self.tail + data[-DOCUMENT_TAIL_SIZE:])[-DOCUMENT_TAIL_SIZE:]
+        return data
+
+    def close(self):
+        """Release the connection back to the pool"""
+        self._eof = True
+        self._buffer = b""
+        self._response.close()
+        if self._release is not None:
+            release, self._release = self._release, None
+            release()
+        if self._stats is not None:
+            url = requestUrl(self._response)
+            if self._reads:
+                self._stats.add(url, "bytes", self.bytes)
+                self._stats.add(url, "fetch_seconds", self.read_seconds)
+            self._stats.add(url, "decompress_seconds", self.decompress_seconds)
+            self._stats = None
 
 
 def isXmlResponse(response):
@@ -93,6 +381,92 @@ def regex(x):
     return x
 
 
+class _CombinedRules(object):
+    """
+    Rule patterns joined into one alternation, each alternative followed by
+    an empty named group that identifies it.
+    """
+
+    def __init__(self, rules):
+        self.values = [v for r, v in rules]
+        self._patterns = [r.pattern for r, v in rules]
+        # Alternations of the first n patterns, compiled as needed
+        self._alternations = [None] * (len(rules) + 1)
+
+    def _alternation(self, n):
+        alternation = self._alternations[n]
+        if alternation is None:
+            alternation = re.compile(
+                "|".join(
+                    f"(?:{pattern})(?P<r{i}>)"
+                    for i, pattern in enumerate(self._patterns[:n])
+                )
+            )
+            self._alternations[n] = alternation
+        return alternation
+
+    def search(self, url):
+        """Return the index of the first rule found in url, or None"""
+        # The alternation finds the first rule matching at the leftmost
+        # position, earlier rules can only match further along.
+        m = self._alternation(len(self.values)).search(url)
+        first = None
+        while m is not None:
+            first = int(m.lastgroup[1:])
+            if first == 0:
+                break
+            m = self._alternation(first).search(url, m.start() + 1)
+        return first
+
+
+class RuleMatcher(object):
+    """
+    Finds the first of an ordered list of (pattern, value) rules whose
+    pattern is found in a url, as if each pattern were searched in turn.
+
+    Consecutive patterns are combined into a single alternation so a url
+    is usually tested against all the rules in one or two regex searches.
+    Patterns with groups or flags of their own are not combined and are
+    searched on their own in their place in the order. An empty pattern
+    matches every url, so it is the fallback for urls no earlier rule
+    matches and later rules are never reached.
+    """
+
+    def __init__(self, rules):
+        self.rules = [(regex(r), v) for r, v in rules]
+        # List of _CombinedRules or (pattern, value), pattern None for a fallback
+        self._steps = []
+        combinable = []
+        for r, v in self.rules:
+            if r.pattern == "":
+                fallback = (None, v)
+                break
+            if r.groups or r.flags & ~re.UNICODE:
+                if combinable:
+                    self._steps.append(_CombinedRules(combinable))
+                    combinable = []
+                self._steps.append((r, v))
+            else:
+                combinable.append((r, v))
+        else:
+            fallback = None
+        if combinable:
+            self._steps.append(_CombinedRules(combinable))
+        if fallback is not None:
+            self._steps.append(fallback)
+
+    def match(self, url):
+        """Return the value of the first rule matching url, or None"""
+        for step in self._steps:
+            if isinstance(step, _CombinedRules):
+                i = step.search(url)
+                if i is not None:
+                    return step.values[i]
+            elif step[0] is None or step[0].search(url):
+                return step[1]
+        return None
+
+
 def sitemapUrlsFromRobots(robots_text, base_url=None):
     """Return iterator over sitemap urls in robots_text"""
     for line in robots_text.splitlines():
@@ -101,18 +475,149 @@ def sitemapUrlsFromRobots(robots_text, base_url=None):
             yield urllib.parse.urljoin(base_url, url)
 
 
+def _counted(items, count):
+    """Yield items, adding one to count[0] for each"""
+    for item in items:
+        count[0] += 1
+        yield item
+
+
+def requestUrl(response):
+    """Return the url originally requested, before any redirects"""
+    return response.history[0].url if response.history else response.url
+
+
+def actionUrl(action):
+    """Return the url to fetch for a sitemapindex or robotsitemap action"""
+    url = action["body"]["url"]
+    if isinstance(url, dict):
+        return url.get(SM_LOC)
+    return url
+
+
 def iterloc(it):
     for d in it:
-        ts = d.get(SM_LASTMOD, None)
-        try:
-            ts = _toDatetimeTZ(d.get(SM_LASTMOD, None))
-        except:
-            L.debug("Failed to parse %s", ts)
-            pass
-        d[SM_LASTMOD] = ts
+        d[SM_LASTMOD] = parseLastmod(d.get(SM_LASTMOD, None))
         yield d
 
 
+def elementValue(el):
+    """Return the text of el, or a dict of its attributes and "@value" text"""
+    if len(el.keys()) > 0:
+        o = {}
+        for k, v in el.items():
+            o[k] = v
+        _v = el.text.strip() if el.text else None
+        if _v is not None:
+            o["@value"] = _v
+        return o
+    return el.text.strip() if el.text else ""
+
+
+@functools.lru_cache(maxsize=1024)
+def _localName(tag):
+    return tag.split("}", 1)[1] if "}" in tag else tag
+
+
+def elementChildren(el):
+    """
+    Return a dict of the children of el keyed by local name, with nested
+    elements as dicts and repeated elements as lists.
+    """
+    d = {}
+    for child in el.getchildren():
+        name = _localName(child.tag)
+        if len(child):
+            v = elementChildren(child)
+        elif child.keys():
+            v = elementValue(child)
+        else:
+            v = child.text.strip() if child.text else ""
+        if name in d:
+            if not isinstance(d[name], list):
+                d[name] = [d[name]]
+            d[name].append(v)
+        else:
+            d[name] = v
+    return d
+
+
+def _addValue(el, extras):
+    extras[el.tag] = elementValue(el)
+
+
+def _addChildren(el, extras):
+    extras[el.tag] = elementChildren(el)
+
+
+def _appendChildren(el, extras):
+    extras.setdefault(el.tag, []).append(elementChildren(el))
+
+
+def _appendAttributes(el, extras):
+    extras.setdefault(el.tag, []).append(dict(el.items()))
+
+
+def _skip(el, extras):
+    pass
+
+
+# Handlers adding an extension element to the extras of its entry, by tag.
+# Elements without a handler are added with elementValue.
+EXTENSION_HANDLERS = {
+    SM_IMAGE: _appendChildren,
+    SM_NEWS: _addChildren,
+    SM_VIDEO: _appendChildren,
+    SM_XHTML_LINK: _skip,
+}
+
+# As EXTENSION_HANDLERS, also collecting xhtml:link alternates
+ALTERNATE_LINK_HANDLERS = dict(EXTENSION_HANDLERS)
+ALTERNATE_LINK_HANDLERS[SM_XHTML_LINK] = _appendAttributes
+
+
+def extensionHandlers(alternate_links=False):
+    """Return the extension handlers, with xhtml:link alternates if alternate_links"""
+    return ALTERNATE_LINK_HANDLERS if alternate_links else EXTENSION_HANDLERS
+
+
+def elementToDict(elem, handlers=EXTENSION_HANDLERS):
+    """Return the dictionary representation of a url or sitemap element"""
+    d = {}
+    for el in elem.getchildren():
+        handlers.get(el.tag, _addValue)(el, d)
+    return d
+
+
+def elementToRecord(elem, kind, source=None, handlers=EXTENSION_HANDLERS):
+    """Return a SitemapRecord for a url or sitemap element, or None without loc"""
+    loc = lastmod = priority = changefreq = extras = None
+    for el in elem.getchildren():
+        tag = el.tag
+        if tag == SM_LOC:
+            loc = el.text.strip() if el.text else ""
+        elif tag == SM_LASTMOD:
+            lastmod = el.text.strip() if el.text else ""
+        elif tag == SM_PRIORITY:
+            priority = el.text.strip() if el.text else ""
+        elif tag == SM_CHANGEFREQ:
+            changefreq = el.text.strip() if el.text else ""
+        else:
+            if extras is None:
+                extras = {}
+            handlers.get(tag, _addValue)(el, extras)
+    if loc is None:
+        return None
+    return SitemapRecord(
+        kind, loc, parseLastmod(lastmod), priority, changefreq, source, extras or None
+    )
+
+
+def entryKind(document_type):
+    """Return the record kind for entries of a sitemapindex or urlset"""
+    return "sitemap" if document_type == "sitemapindex" else "url"
+
+
 class SiteMapIterator(object):
     """
     Iterates over a single XML sitemap document.
@@ -120,34 +625,286 @@ class SiteMapIterator(object):
     Yields a dictionary with keys as {namespace}element_name. If the
     element has attributes, then a dictionary is provided with
     attributes as keys and "@value" the value of the element, if any.
+    Extension elements are added by handlers, see EXTENSION_HANDLERS.
+
+    truncated is True if the document ended before its root element was
+    closed, in which case entries may be missing.
     """
 
-    def __init__(self, xml_text):
-        xmlp = lxml.etree.XMLParser(
+    def __init__(self, xml_text=None, root=None):
+        if root is None:
+            root = lxml.etree.fromstring(xml_text, parser=self._parser())
+        self._root = root
+        self.type = _localName(self._root.tag)
+        self.handlers = EXTENSION_HANDLERS
+        self.truncated = xml_text is not None and not rootClosed(
+            xml_text[-DOCUMENT_TAIL_SIZE:], self._root.tag
+        )
+
+    @staticmethod
+    def _parser():
+        return lxml.etree.XMLParser(
             recover=True, remove_comments=True, resolve_entities=False
         )
-        self._root = lxml.etree.fromstring(xml_text, parser=xmlp)
-        rt = self._root.tag
-        self.type = self._root.tag.split("}", 1)[1] if "}" in rt else rt
+
+    @classmethod
+    def fromFile(cls, source):
+        """
+        Parse the document read from a file-like source, such as a
+        ResponseStream, without first holding the whole body in memory.
+        """
+        root = lxml.etree.parse(source, parser=cls._parser()).getroot()
+        if root is None:
+            raise lxml.etree.XMLSyntaxError("Document is empty", None, 0, 0)
+        document = cls(root=root)
+        document.truncated = getattr(source, "truncated", False) or not rootClosed(
+            getattr(source, "tail", None), root.tag
+        )
+        return document
 
     def __iter__(self):
         for elem in self._root.getchildren():
-            d = {}
-            for el in elem.getchildren():
-                tag = el.tag
-                if len(el.keys()) > 0:
-                    o = {}
-                    for k, v in el.items():
-                        o[k] = v
-                    _v = el.text.strip() if el.text else None
-                    if _v is not None:
-                        o["@value"] = _v
-                    d[tag] = o
-                else:
-                    d[tag] = el.text.strip() if el.text else ""
+            d = elementToDict(elem, self.handlers)
+            if SM_LOC in d:
+                yield d
+
+    def records(self, source=None):
+        """Yield a SitemapRecord for each entry"""
+        kind = entryKind(self.type)
+        for elem in self._root.getchildren():
+            record = elementToRecord(elem, kind, source, self.handlers)
+            if record is not None:
+                yield record
+
+
+class SiteMapStreamIterator(object):
+    """
+    Iterates over a single XML sitemap document read from a file-like source.
+
+    Yields the same dictionaries as SiteMapIterator, but parses incrementally
+    with iterparse and discards each element after it is yielded, so memory
+    use does not grow with the size of the document.
+    """
+
+    def __init__(self, source):
+        self._source = source
+        self._events = lxml.etree.iterparse(
+            source,
+            events=("start", "end"),
+            recover=True,
+            remove_comments=True,
+            resolve_entities=False,
+        )
+        self._root = None
+        self.type = None
+        # Set when parsing stops before the end of the document, or the
+        # document ends before its root element is closed
+        self.truncated = False
+        self.handlers = EXTENSION_HANDLERS
+        try:
+            for event, elem in self._events:
+                self._root = elem
+                self.type = _localName(elem.tag)
+                break
+        except lxml.etree.XMLSyntaxError as e:
+            L.warning("Unable to parse sitemap: %s", e)
+
+    def _elements(self):
+        """Yield each entry element, discarding it once the caller resumes"""
+        if self._root is None:
+            return
+        depth = 1
+        try:
+            for event, elem in self._events:
+                if event == "start":
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+                yield elem
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del self._root[0]
+            if getattr(self._source, "truncated", False) or not rootClosed(
+                getattr(self._source, "tail", None), self._root.tag
+            ):
+                L.warning("Sitemap is incomplete")
+                self.truncated = True
+        except lxml.etree.XMLSyntaxError as e:
+            L.warning("Stopped parsing sitemap: %s", e)
+            self.truncated = True
+        finally:
+            if hasattr(self._source, "close"):
+                self._source.close()
+
+    def __iter__(self):
+        for elem in self._elements():
+            d = elementToDict(elem, self.handlers)
             if SM_LOC in d:
                 yield d
 
+    def records(self, source=None):
+        """Yield a SitemapRecord for each entry"""
+        kind = entryKind(self.type)
+        for elem in self._elements():
+            record = elementToRecord(elem, kind, source, self.handlers)
+            if record is not None:
+                yield record
+
+
+class ValidatorCache(object):
+    """
+    In memory store of the HTTP validators (ETag and Last-Modified) for
+    each sitemap url, used to send conditional requests.
+    """
+
+    def __init__(self):
+        self._validators = {}
+
+    def get(self, url):
+        """Return (etag, last_modified) for url or None"""
+        return self._validators.get(url)
+
+    def put(self, url, etag, last_modified):
+        self._validators[url] = (etag, last_modified)
+
+    def conditionalHeaders(self, url):
+        headers = {}
+        validators = self.get(url)
+        if validators is not None:
+            etag, last_modified = validators
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def update(self, response):
+        """Record the validators of a successful response"""
+        if response.status_code != 200:
+            return
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            self.put(requestUrl(response), etag, last_modified)
+
+
+def parseDocumentBody(body, alternate_links=False, truncated=False):
+    """
+    Parse a sitemap document body into (type, records, seconds, truncated).
+
+    Each record is a compact tuple of (loc, lastmod, priority, changefreq,
+    extras) where extras is a dict of any other elements or None. This runs
+    in worker processes, so the result is kept small and picklable. seconds
+    is the time taken to parse. xhtml:link alternates are included in
+    extras if alternate_links is True. truncated is returned True if it was
+    passed True, as for a body that could not be fully gunzipped, or the
+    document is incomplete. type is None if the body could not be parsed.
+    """
+    t0 = time.perf_counter()
+    try:
+        s = SiteMapIterator(body)
+    except lxml.etree.XMLSyntaxError as e:
+        # lxml errors can not be pickled back to the parent process
+        L.warning("Unable to parse sitemap: %s", e)
+        return None, [], time.perf_counter() - t0, True
+    s.handlers = extensionHandlers(alternate_links)
+    records = [
+        (r.loc, r.lastmod, r.priority, r.changefreq, r.extras) for r in s.records()
+    ]
+    truncated = truncated or s.truncated
+    return s.type, records, time.perf_counter() - t0, truncated
+
+
+class ParsedDocument(object):
+    """
+    Iterates over records returned by parseDocumentBody, yielding the
+    same dictionaries as SiteMapIterator.
+    """
+
+    def __init__(self, type, records, parse_seconds=0.0, truncated=False):
+        self.type = type
+        self._records = records
+        self.parse_seconds = parse_seconds
+        self.truncated = truncated
+
+    def __iter__(self):
+        for loc, lastmod, priority, changefreq, extras in self._records:
+            d = {SM_LOC: loc, SM_LASTMOD: lastmod}
+            if priority is not None:
+                d[SM_PRIORITY] = priority
+            if changefreq is not None:
+                d[SM_CHANGEFREQ] = changefreq
+            if extras is not None:
+                d.update(extras)
+            yield d
+
+    def records(self, source=None):
+        """Yield a SitemapRecord for each entry"""
+        kind = entryKind(self.type)
+        for loc, lastmod, priority, changefreq, extras in self._records:
+            yield SitemapRecord(kind, loc, lastmod, priority, changefreq, source, extras)
+
+
+class VisitedSet(object):
+    """
+    Set of the sitemap urls visited by a crawl, holding at most max_size.
+
+    When full, the oldest url is forgotten to make room, so memory use is
+    bounded however many sitemaps are crawled. A forgotten url could be
+    visited again, which the depth limit of a crawl keeps finite.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_MAX_SITEMAPS):
+        self.max_size = max(1, max_size)
+        # dict preserves insertion order, the first key is the oldest
+        self._urls = {}
+        self.evicted = 0
+
+    def add(self, url):
+        """Add url, returning False if it was already present"""
+        if url in self._urls:
+            return False
+        if len(self._urls) >= self.max_size:
+            del self._urls[next(iter(self._urls))]
+            self.evicted += 1
+        self._urls[url] = None
+        return True
+
+    def __contains__(self, url):
+        return url in self._urls
+
+    def __len__(self):
+        return len(self._urls)
+
+    def __iter__(self):
+        return iter(self._urls)
+
+
+class HostLimits(object):
+    """
+    Semaphores limiting concurrent requests to each host.
+
+    A single HostLimits can be shared by SiteMap instances crawling in
+    different threads, so the limit applies across all of them.
+    """
+
+    def __init__(self, per_host: int = 2):
+        self.per_host = max(1, per_host)
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """Return the semaphore for the host of url"""
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            limit = self._limits.get(host)
+            if limit is None:
+                limit = threading.BoundedSemaphore(self.per_host)
+                self._limits[host] = limit
+        return limit
+
 
 class BaseTask:
     def __init__(self):
@@ -170,7 +927,25 @@ class RobotstxtTask(BaseTask):
 
 
 class SiteMap(object):
-    def __init__(self, url, start_from: datetime.datetime = None, alt_rules=None):
+    def __init__(
+        self,
+        url,
+        start_from: datetime.datetime = None,
+        alt_rules=None,
+        max_workers: int = 1,
+        per_host: int = 2,
+        ordered: bool = True,
+        streaming: bool = False,
+        validators: ValidatorCache = None,
+        known_lastmod=None,
+        parse_workers: int = 0,
+        session: requests.Session = None,
+        completed=None,
+        host_limits: HostLimits = None,
+        stats: smcat.metrics.CrawlStats = None,
+        max_depth: int = DEFAULT_MAX_DEPTH,
+        max_sitemaps: int = DEFAULT_MAX_SITEMAPS,
+    ):
         """
         Initialize a SiteMap object
 
@@ -179,28 +954,96 @@ class SiteMap(object):
             start_from: Optional, entries with lastmod > start_from are returned
             alt_rules: Optional, list of (expression, callback) applied to each
               entry. If the expression (regexp string) matches the loc value for
-              a url entry, then callback is called with the url structure
+              a url entry, then callback is called with the url structure.
+              Only the callback of the first matching rule is called.
+            max_workers: Number of threads fetching child sitemaps. With more
+              than one, child sitemaps are fetched ahead while earlier ones
+              are being parsed.
+            per_host: Maximum concurrent requests to a single host. A request
+              holds its slot until its body has been read, except when
+              streaming, where documents stay open while the sitemaps below
+              them are fetched and the slot is released with the headers.
+            ordered: If True, child sitemaps are processed in document order,
+              otherwise in the order their fetches complete
+            streaming: If True, documents are parsed incrementally as they
+              are read from the network instead of being loaded in full
+            validators: Optional ValidatorCache. If provided, requests are
+              conditional and sitemaps that respond 304 Not Modified are
+              skipped along with everything below them
+            known_lastmod: Optional mapping of child sitemap loc to the lastmod
+              recorded by a previous crawl. Child sitemaps whose sitemapindex
+              lastmod is not newer are yielded but not fetched.
+            parse_workers: Number of processes parsing sitemap documents. When
+              set, fetched bodies are parsed in a process pool, overlapping
+              with fetches when max_workers > 1. Implies streaming=False.
+            session: Optional requests.Session used for all requests. The
+              default is from smcat.transport.createSession, with timeouts,
+              retries and a connection pool sized for per_host.
+            completed: Optional set of child sitemap urls already processed,
+              for example by an interrupted crawl. These are not fetched.
+            host_limits: Optional HostLimits shared with other SiteMaps, used
+              instead of per_host to limit concurrent requests to each host.
+            stats: Optional CrawlStats to record counters and timings in. A
+              new one is created if not provided, available as self.stats.
+            max_depth: Child sitemaps more than max_depth levels below url
+              are not fetched
+            max_sitemaps: Number of sitemap urls remembered in self.visited.
+              A sitemap already visited by the crawl, such as one listed
+              twice or in a cycle of sitemapindexes, is not fetched again.
 
         """
         self.sitemap_url = url
+        # Collect xhtml:link alternates of url entries into their extras
         self.sitemap_alternate_links = False
         self.sitemap_rules = [("", "parseUrl")]
         self.sitemap_follow = [""]
         self.start_from = start_from
-        self._session = requests.Session()
-        self._cbs = []
-        self._all_sitemaps = []  # list of all sitemaps visited
-        if alt_rules is not None:
-            for r, c in alt_rules:
-                if isinstance(c, str):
-                    c = getattr(self, c)
-                self._cbs.append((regex(r), c))
-        else:
-            for r, c in self.sitemap_rules:
-                if isinstance(c, str):
-                    c = getattr(self, c)
-                self._cbs.append((regex(r), c))
-        self._follow = [regex(x) for x in self.sitemap_follow]
+        self.max_workers = max(1, max_workers)
+        self.per_host = max(1, per_host)
+        self.ordered = ordered
+        self.streaming = streaming
+        self.validators = validators
+        self.known_lastmod = known_lastmod
+        self.completed = completed
+        self.parse_workers = max(0, parse_workers)
+        if self.parse_workers and self.streaming:
+            L.warning("Streaming is not used with parse workers")
+            self.streaming = False
+        self._parse_pool = None
+        self._documents = {}  # response -> future of parseDocumentBody
+        self._host_slots = {}  # response -> release of its host slot
+        self._listed_lastmods = {}  # child url -> lastmod listed by its index
+        # Bodies are read from the socket by the parser, unless fetch threads
+        # download them ahead or they are sent whole to the parse workers
+        self._stream_bodies = self.streaming or (
+            self.max_workers == 1 and not self.parse_workers
+        )
+        if session is None:
+            session = smcat.transport.createSession(
+                pool_size=max(smcat.transport.DEFAULT_POOL_SIZE, self.per_host)
+            )
+        self._session = session
+        self._executor = None
+        if host_limits is None:
+            host_limits = HostLimits(self.per_host)
+        self._host_limits = host_limits
+        if stats is None:
+            stats = smcat.metrics.CrawlStats()
+        self.stats = stats
+        self.max_depth = max(0, max_depth)
+        self.max_sitemaps = max_sitemaps
+        # sitemaps fetched or scheduled for fetching by the current crawl
+        self.visited = VisitedSet(max_sitemaps)
+        # sitemaps whose entries were all read and kept
+        self.parsed_sitemaps = set()
+        self.lastmod_failures = 0  # lastmod values that could not be parsed
+        rules = []
+        for r, c in alt_rules if alt_rules is not None else self.sitemap_rules:
+            if isinstance(c, str):
+                c = getattr(self, c)
+            rules.append((r, c))
+        self._rules = RuleMatcher(rules)
+        self._follow = RuleMatcher([(x, True) for x in self.sitemap_follow])
 
     def parseUrl(self, task):
         """Return an object given an entry"""
@@ -213,8 +1056,107 @@ class SiteMap(object):
         for entry in entries:
             yield entry
 
+    def sitemapCompleted(self, response, complete=True):
+        """
+        Called after everything below the sitemap in response has been yielded.
+
+        complete is False if the sitemap or one below it failed to load, was
+        incomplete or had entries left out by the filters. Validators are
+        only stored for complete sitemaps, so a later conditional load does
+        not skip what this one missed.
+        """
+        if self.validators is not None and complete:
+            self.validators.update(response)
+
+    def _documentComplete(self, response):
+        """True if every entry of the document in response was read and kept"""
+        if response.status_code == 304:
+            return True
+        if response.status_code != 200:
+            return False
+        if response.url.endswith("/robots.txt"):
+            return True
+        return requestUrl(response) in self.parsed_sitemaps
+
+    def _documentRead(self, response, document, read, kept):
+        """
+        Add response to parsed_sitemaps if document was read to the end
+        and kept all of the read entries.
+        """
+        url = requestUrl(response)
+        if getattr(document, "truncated", False):
+            L.warning("Incomplete sitemap: %s", url)
+        elif kept < read:
+            L.info("Entries filtered from sitemap: %s", url)
+        elif response.status_code == 200:
+            self.parsed_sitemaps.add(url)
+
+    def _popDocument(self, stack):
+        """
+        Pop the frame [actions, response, depth, complete] at the top of
+        stack, calling sitemapCompleted for its response if any. Whether it
+        is complete is passed on to the frame below, which is returned.
+        """
+        _, response, _, complete = stack.pop()
+        if response is not None:
+            # In case the document was never opened
+            self._releaseHost(response)
+            complete = complete and self._documentComplete(response)
+            self.sitemapCompleted(response, complete)
+        if stack:
+            stack[-1][3] = stack[-1][3] and complete
+        return response, complete
+
+    def _reportLastmodFailures(self, response, failures):
+        if failures:
+            self.lastmod_failures += failures
+            self.stats.add(requestUrl(response), "lastmod_failures", failures)
+            L.warning(
+                "%s lastmod values could not be parsed in %s",
+                failures,
+                requestUrl(response),
+            )
+
+    def skipSitemap(self, loc, lastmod):
+        """True if a child sitemap listed in a sitemapindex need not be fetched"""
+        if self.completed is not None and loc in self.completed:
+            return True
+        if self.known_lastmod is None:
+            return False
+        stored = self.known_lastmod.get(loc)
+        if stored is None:
+            return False
+        return not isNewer(lastmod, stored)
+
+    def followSitemap(self, url, depth):
+        """
+        True if the child sitemap url, depth levels below the root, should
+        be fetched. It is then recorded as visited.
+        """
+        if depth > self.max_depth:
+            L.warning("Not following sitemap beyond depth %s: %s", self.max_depth, url)
+            return False
+        if not self.visited.add(url):
+            L.warning("Not following sitemap visited before: %s", url)
+            return False
+        return True
+
+    def _startCrawl(self):
+        self.visited = VisitedSet(self.max_sitemaps)
+        self.visited.add(self.sitemap_url)
+
+    def isAfterStart(self, lastmod):
+        """
+        True if a url entry with lastmod is returned given start_from.
+        Entries without a lastmod, or with one that could not be parsed,
+        are returned.
+        """
+        return self.start_from is None or isNewer(lastmod, self.start_from)
+
     def parseSitemap(self, response):
-        self._all_sitemaps.append(response.url)
+        if response.status_code == 304:
+            L.info("Not modified: %s", requestUrl(response))
+            return
         if response.url.endswith("/robots.txt"):
             for url in sitemapUrlsFromRobots(response.text, base_url=response.url):
                 yield {
@@ -222,95 +1164,507 @@ class SiteMap(object):
                     "body": {"url": url, "cb": self.parseSitemap},
                 }
         else:
-            body = self.getSitemapBody(response)
-            if body is None:
+            s = self.openDocument(response)
+            if s is None:
                 L.warning("Ignoring invalid sitemap: %s", response.url)
                 return
-            s = SiteMapIterator(body)
             L.info("Sitemap type = %s", s.type)
-            s_it = self.sitemapFilter(s)
+            read = [0]
+            s_it = self.sitemapFilter(
+                self.stats.parsing(requestUrl(response), _counted(s, read))
+            )
+            failures = 0
+            kept = 0
             if s.type == "sitemapindex":
                 for url in iterloc(s_it):
-                    if any(x.search(url[SM_LOC]) for x in self._follow):
+                    if isLastmodFailure(url[SM_LASTMOD]):
+                        failures += 1
+                    if self._follow.match(url[SM_LOC]) is None:
+                        continue
+                    kept += 1
+                    if self.skipSitemap(url[SM_LOC], url.get(SM_LASTMOD)):
+                        L.debug("Skipping sitemap: %s", url[SM_LOC])
+                        yield {
+                            "task": "sitemapunchanged",
+                            "body": {
+                                "kind": "sitemap",
+                                "url": url,
+                                "source": requestUrl(response),
+                            },
+                        }
+                    else:
                         yield {
                             "task": "sitemapindex",
                             "body": {
                                 "kind": "sitemap",
                                 "url": url,
                                 "cb": self.parseSitemap,
-                                "source": response.history[0].url if response.history else response.url,
+                                "source": requestUrl(response),
                             },
                         }
             elif s.type == "urlset":
                 # recall that a url in a urlset is a structure containing loc (the url value)
                 for url in iterloc(s_it):
-                    for r, c in self._cbs:
-                        if (
-                            r.search(url[SM_LOC])
-                            and self.start_from is None
-                            or url[SM_LASTMOD] >= self.start_from
-                        ):
-                            req = {
-                                "task": "url",
-                                "body": {
-                                    "kind": "url",
-                                    "url": url,
-                                    "cb": c,
-                                    "source": response.history[0].url if response.history else response.url,
-                                },
-                            }
-                            # L.debug("REQ: %s", req)
-                            yield req
-
-    def getSitemapBody(self, response):
+                    if isLastmodFailure(url[SM_LASTMOD]):
+                        failures += 1
+                    if not self.isAfterStart(url[SM_LASTMOD]):
+                        continue
+                    c = self._rules.match(url[SM_LOC])
+                    if c is None:
+                        continue
+                    kept += 1
+                    req = {
+                        "task": "url",
+                        "body": {
+                            "kind": "url",
+                            "url": url,
+                            "cb": c,
+                            "source": requestUrl(response),
+                        },
+                    }
+                    # L.debug("REQ: %s", req)
+                    yield req
+            self._reportLastmodFailures(response, failures)
+            self._documentRead(response, s, read[0], kept)
+
+    def openDocument(self, response):
+        """
+        Return an iterator over the entries of the sitemap in response, or
+        None if it is not a sitemap or could not be parsed.
+        """
+        if self._parse_pool is not None:
+            future = self._documents.pop(response, None)
+            if future is None:
+                future = self._submitParse(response)
+            if future is None:
+                return None
+            document = ParsedDocument(*future.result())
+            if document.type is None:
+                return None
+            self.stats.add(requestUrl(response), "parse_seconds", document.parse_seconds)
+            return document
+        stream = ResponseStream(
+            response,
+            stats=self.stats,
+            reads=self._stream_bodies,
+            release=self._host_slots.pop(response, None),
+        )
+        if not (
+            stream.gzipped
+            or isXmlResponse(response)
+            or response.url.endswith(".xml.gz")
+        ):
+            stream.close()
+            L.warning("openDocument no xml: %s", response.url)
+            return None
+        if self.streaming:
+            try:
+                document = SiteMapStreamIterator(stream)
+            except zlib.error as e:
+                stream.close()
+                L.warning("Unable to parse sitemap %s: %s", response.url, e)
+                return None
+            if document.type is None:
+                stream.close()
+                return None
+            document.handlers = extensionHandlers(self.sitemap_alternate_links)
+            return document
+        # Decompressed chunks are fed to the parser as they are read
+        t0 = time.perf_counter()
+        try:
+            document = SiteMapIterator.fromFile(stream)
+        except (lxml.etree.XMLSyntaxError, zlib.error) as e:
+            L.warning("Unable to parse sitemap %s: %s", response.url, e)
+            return None
+        finally:
+            stream.close()
+        document.handlers = extensionHandlers(self.sitemap_alternate_links)
+        self.stats.add(
+            requestUrl(response),
+            "parse_seconds",
+            max(
+                0.0,
+                time.perf_counter() - t0 - stream.read_seconds - stream.decompress_seconds,
+            ),
+        )
+        return document
+
+    def getSitemapBody(self, response, on_truncated=None):
         if isXmlResponse(response):
             return response.content
         elif gzipMagicNumber(response):
-            return gunzip(response.content)
+            with self.stats.timer(requestUrl(response), "decompress_seconds"):
+                return gunzip(response.content, on_truncated=on_truncated)
         elif response.url.endswith(".xml") or response.url.endswith(".xml.gz"):
             return response.content
         L.warning("getSitemapBody no xml: %s", response.url)
 
-    def _scanItems(self, iter=None):
-        if isinstance(iter, types.GeneratorType):
-            for action in iter:
-                task = action.get("task", None)
-                # yield the action to be undertaken.
-                # This will generally be ignored by the receiver
-                yield action
-                if task in ["sitemapindex", "robotsitemap"]:
-                    # load a sitemap body from the provided url
-                    cb = action["body"].pop("cb")
-                    yield action["body"]
-                    url = action["body"]["url"].get(SM_LOC)
-                    r = self._session.get(url)
-                    # default action is parseSitemap(r)
-                    _iterator = cb(r)
-                    for item in self._scanItems(_iterator):
-                        yield item
-                elif task == "url":
-                    # Handle a single URL entry
-                    cb = action["body"].pop("cb")
-                    params = action["body"]
-                    # default callback is parse({"url": url}), where url is a
-                    # url structure parsed from a urlset. The parse()
-                    # method just returns the structure, so by default we
-                    # are just yielding the url structure here.
-                    _iterator = cb(params)
-                    for item in self._scanItems(_iterator):
-                        yield (item)
+    def _hostLimit(self, url):
+        return self._host_limits.get(url)
+
+    def _releaseHost(self, response):
+        """Release the host slot still held for response, if any"""
+        release = self._host_slots.pop(response, None)
+        if release is not None:
+            release()
+
+    def _fetch(self, url):
+        headers = None
+        if self.validators is not None:
+            headers = self.validators.conditionalHeaders(url)
+        t0 = time.perf_counter()
+        limit = self._hostLimit(url)
+        limit.acquire()
+        try:
+            response = self._session.get(
+                url, headers=headers, stream=self._stream_bodies
+            )
+        except BaseException:
+            limit.release()
+            raise
+        if (
+            self._stream_bodies
+            and not self.streaming
+            and response.status_code == 200
+            and not response.url.endswith("/robots.txt")
+        ):
+            # The body is read whole by openDocument before anything else is
+            # fetched, the slot is released when its ResponseStream is closed
+            self._host_slots[response] = limit.release
+        else:
+            limit.release()
+        stats = self.stats.sitemap(url)
+        stats.status = response.status_code
+        self.stats.add(url, "latency_seconds", response.elapsed.total_seconds())
+        if not self._stream_bodies:
+            # The body has been read, streamed bodies are counted by ResponseStream
+            self.stats.add(url, "bytes", len(response.content))
+        self.stats.add(url, "fetch_seconds", time.perf_counter() - t0)
+        return response
+
+    def _submitParse(self, response):
+        if response.status_code == 304 or response.url.endswith("/robots.txt"):
+            return None
+        truncated = []
+        try:
+            body = self.getSitemapBody(
+                response, on_truncated=lambda: truncated.append(True)
+            )
+        except zlib.error as e:
+            L.warning("Unable to gunzip sitemap %s: %s", response.url, e)
+            return None
+        if body is None:
+            return None
+        return self._parse_pool.submit(
+            parseDocumentBody, body, self.sitemap_alternate_links, bool(truncated)
+        )
+
+    def _prefetch(self, url):
+        """Fetch url and, with parse workers, start parsing the body"""
+        response = self._fetch(url)
+        if self._parse_pool is not None:
+            future = self._submitParse(response)
+            if future is not None:
+                self._documents[response] = future
+        return response
+
+    def _startExecutor(self):
+        if self.parse_workers and self._parse_pool is None:
+            # spawn, since forking with fetch threads running is unsafe
+            self._parse_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.parse_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        if self.max_workers > 1 and self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="smcat-fetch"
+            )
+
+    def _stopExecutor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._parse_pool is not None:
+            self._parse_pool.shutdown(wait=True, cancel_futures=True)
+            self._parse_pool = None
+        self._documents = {}
+        # Slots of documents left unread when a crawl stops early
+        for response in list(self._host_slots):
+            self._releaseHost(response)
+
+    def _nextCompleted(self, pending):
+        if self.ordered or pending[0][1] is None:
+            action, future = pending.popleft()
+            yield action, future.result if future is not None else None
             return
-        yield iter
+        futures = [f for _, f in pending if f is not None]
+        done, _ = concurrent.futures.wait(
+            futures, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for entry in [e for e in pending if e[1] in done]:
+            pending.remove(entry)
+            yield entry[0], entry[1].result
+
+    def _iterFetches(self, pairs):
+        """
+        Given (item, url) pairs, where url is None or a sitemap to fetch,
+        yield (item, fetch) where fetch is None or a callable returning the
+        response for url.
+
+        When a thread pool is available, fetches are submitted up to
+        2 * max_workers items ahead of the one being yielded.
+        """
+        if self._executor is None:
+            for action, url in pairs:
+                if url is not None:
+                    yield action, functools.partial(self._fetch, url)
+                else:
+                    yield action, None
+            return
+        window = self.max_workers * 2
+        pending = collections.deque()
+        for action, url in pairs:
+            if url is not None:
+                future = self._executor.submit(self._prefetch, url)
+                pending.append((action, future))
+            elif pending:
+                pending.append((action, None))
+            else:
+                yield action, None
+                continue
+            while len(pending) >= window:
+                yield from self._nextCompleted(pending)
+        while pending:
+            yield from self._nextCompleted(pending)
+
+    def _actionUrl(self, action, depth):
+        """
+        Return the url to fetch for action, or None. Sitemaps not followed
+        at depth are changed to a "sitemapskipped" task.
+        """
+        if action.get("task", None) not in FETCH_TASKS:
+            return None
+        url = actionUrl(action)
+        if self.followSitemap(url, depth):
+            return url
+        action["task"] = "sitemapskipped"
+        action["body"].pop("cb", None)
+        return None
+
+    def _iterActions(self, actions, depth=1):
+        """
+        Yield (action, fetch) for each action, see _iterFetches. Sitemaps
+        are fetched as depth levels below the root.
+        """
+        return self._iterFetches((a, self._actionUrl(a, depth)) for a in actions)
+
+    def _scanItems(self, iter=None, response=None):
+        if not isinstance(iter, types.GeneratorType):
+            yield iter
+            if response is not None:
+                self.sitemapCompleted(response, self._documentComplete(response))
+            return
+        # Work stack of [actions, response, depth, complete] for each
+        # document being scanned, response is completed when its actions
+        # are exhausted, depth is the level of the document below the root
+        # and complete is cleared when a document below it is incomplete.
+        stack = [[self._iterActions(iter, 1), response, 0, True]]
+        while stack:
+            actions, response, depth, _ = stack[-1]
+            try:
+                action, fetch = next(actions)
+            except StopIteration:
+                self._popDocument(stack)
+                continue
+            task = action.get("task", None)
+            # yield the action to be undertaken.
+            # This will generally be ignored by the receiver
+            yield action
+            if task in FETCH_TASKS:
+                # load a sitemap body from the provided url
+                cb = action["body"].pop("cb")
+                yield action["body"]
+                r = fetch()
+                # default action is parseSitemap(r)
+                result = cb(r)
+                if isinstance(result, types.GeneratorType):
+                    child_depth = depth + 1
+                    stack.append(
+                        [self._iterActions(result, child_depth + 1), r, child_depth, True]
+                    )
+                else:
+                    yield result
+                    stack.append([None, r, depth + 1, True])
+                    self._popDocument(stack)
+            elif task in ("sitemapunchanged", "sitemapskipped"):
+                # Record the entry without following it
+                yield action["body"]
+            elif task == "url":
+                # Handle a single URL entry
+                cb = action["body"].pop("cb")
+                params = action["body"]
+                # default callback is parse({"url": url}), where url is a
+                # url structure parsed from a urlset. The parse()
+                # method just returns the structure, so by default we
+                # are just yielding the url structure here.
+                result = cb(params)
+                if isinstance(result, types.GeneratorType):
+                    stack.append([self._iterActions(result, depth + 1), None, depth, True])
+                else:
+                    yield result
+
+    def recordFilter(self, records):
+        """Override this to filter records"""
+        for record in records:
+            yield record
+
+    def _documentRecords(self, response, depth=1):
+        """
+        Yield (record, url) for the entries of the document in response,
+        where url is None or a child sitemap to fetch, depth levels below
+        the root.
+
+        The document is added to parsed_sitemaps if it was read to the end
+        and none of its entries were left out by recordFilter, start_from,
+        the rules or sitemap_follow.
+        """
+        if response.status_code == 304:
+            L.info("Not modified: %s", requestUrl(response))
+            return
+        if response.url.endswith("/robots.txt"):
+            for url in sitemapUrlsFromRobots(response.text, base_url=response.url):
+                if self.skipSitemap(url, None):
+                    L.debug("Skipping sitemap: %s", url)
+                    continue
+                if self.followSitemap(url, depth):
+                    yield None, url
+            return
+        s = self.openDocument(response)
+        if s is None:
+            L.warning("Ignoring invalid sitemap: %s", response.url)
+            return
+        L.info("Sitemap type = %s", s.type)
+        url = requestUrl(response)
+        read = [0]
+        records = self.recordFilter(
+            self.stats.parsing(url, _counted(s.records(source=url), read))
+        )
+        failures = 0
+        kept = 0
+        if s.type == "sitemapindex":
+            for record in records:
+                if isLastmodFailure(record.lastmod):
+                    failures += 1
+                if self._follow.match(record.loc) is None:
+                    continue
+                kept += 1
+                if self.skipSitemap(record.loc, record.lastmod):
+                    L.debug("Skipping sitemap: %s", record.loc)
+                    yield record, None
+                    continue
+                if not self.followSitemap(record.loc, depth):
+                    yield record, None
+                    continue
+                if not isLastmodFailure(record.lastmod):
+                    self._listed_lastmods[record.loc] = record.lastmod
+                yield record, record.loc
+        elif s.type == "urlset":
+            for record in records:
+                if isLastmodFailure(record.lastmod):
+                    failures += 1
+                if not self.isAfterStart(record.lastmod):
+                    continue
+                c = self._rules.match(record.loc)
+                if c is None:
+                    continue
+                result = c(record)
+                if isinstance(result, types.GeneratorType):
+                    kept += 1
+                    for item in result:
+                        yield item, None
+                elif result is not None:
+                    kept += 1
+                    yield result, None
+        self._reportLastmodFailures(response, failures)
+        self._documentRead(response, s, read[0], kept)
+
+    def _completedRecord(self, response, source=None, complete=True):
+        # lastmod is that listed by the parent sitemapindex, if any
+        url = requestUrl(response)
+        return SitemapRecord(
+            "completed",
+            url,
+            lastmod=self._listed_lastmods.pop(url, None),
+            source=source,
+            extras={"parsed": complete and url in self.parsed_sitemaps},
+        )
+
+    def _scanRecords(self, response, completed=False):
+        # Work stack of [pairs, response, depth, complete] for each document
+        # being scanned, as for _scanItems. Entries of the innermost document
+        # are yielded first.
+        stack = [
+            [self._iterFetches(self._documentRecords(response, 1)), response, 0, True]
+        ]
+        while stack:
+            pairs, r, depth, _ = stack[-1]
+            try:
+                record, fetch = next(pairs)
+            except StopIteration:
+                r, complete = self._popDocument(stack)
+                if completed:
+                    source = requestUrl(stack[-1][1]) if stack else None
+                    yield self._completedRecord(r, source=source, complete=complete)
+                continue
+            if record is not None:
+                yield record
+            if fetch is not None:
+                child = fetch()
+                child_depth = depth + 1
+                pairs = self._iterFetches(self._documentRecords(child, child_depth + 1))
+                stack.append([pairs, child, child_depth, True])
+
+    def records(self, completed=False):
+        """
+        Iterate over the sitemap, yielding a SitemapRecord for each sitemap
+        and url entry.
+
+        This is a lighter alternative to iterating the SiteMap, which yields
+        nested dictionaries plus the actions used to produce them. Entries
+        are filtered by recordFilter rather than sitemapFilter. Rule callbacks
+        are called with the record and their result is yielded in its place.
+        SitemapRecord.asItem converts a record to the dictionary format.
+
+        If completed is True, a record of kind "completed" with the url of
+        each sitemap document is yielded after everything below it. Its
+        extras["parsed"] is True if every entry of the document was read and
+        kept and every sitemap fetched below it was complete. It is False if
+        the document was not modified, invalid or truncated, had entries left
+        out by the filters, or a sitemap below it failed. Its lastmod is the
+        one listed for the document by its sitemapindex, or None.
+        """
+        self._startCrawl()
+        self._startExecutor()
+        try:
+            response = self._fetch(self.sitemap_url)
+            yield from self._scanRecords(response, completed=completed)
+        finally:
+            self._stopExecutor()
 
     def scanItems(self):
-        response = self._session.get(self.sitemap_url)
+        self._startCrawl()
+        response = self._fetch(self.sitemap_url)
         iter = self.parseSitemap(response)
-        return self._scanItems(iter)
+        yield from self._scanItems(iter, response)
 
     def __iter__(self):
-        for item in self.scanItems():
-            L.debug(f"ITER: {item}")
-            yield item
+        self._startExecutor()
+        try:
+            for item in self.scanItems():
+                L.debug(f"ITER: {item}")
+                yield item
+        finally:
+            self._stopExecutor()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+"""
+HTTP transport configuration for fetching sitemaps.
+
+createSession returns a requests.Session with bounded connection pools,
+default connect and read timeouts, and retries with backoff on transient
+errors, honouring Retry-After.
+"""
+import logging
+import requests
+import requests.adapters
+import urllib3.util
+
+_L = logging.getLogger("transport")
+
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 60.0
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_POOL_SIZE = 10
+
+# Status codes retried with backoff
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class TimeoutSession(requests.Session):
+    """requests.Session that applies a default timeout to every request"""
+
+    def __init__(self, timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+def createSession(
+    pool_size: int = DEFAULT_POOL_SIZE,
+    pool_hosts: int = DEFAULT_POOL_SIZE,
+    connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+    read_timeout: float = DEFAULT_READ_TIMEOUT,
+    retries: int = DEFAULT_RETRIES,
+    backoff_factor: float = DEFAULT_BACKOFF,
+    user_agent: str = None,
+):
+    """
+    Create a session for fetching sitemaps.
+
+    Args:
+        pool_size: Maximum connections kept open to each host
+        pool_hosts: Number of per-host connection pools to keep
+        connect_timeout: Seconds to wait for a connection
+        read_timeout: Seconds to wait between bytes of a response
+        retries: Retries for connection errors and RETRY_STATUS responses
+        backoff_factor: Backoff between retries is backoff_factor * 2 ** (n - 1)
+          seconds, unless the response provides Retry-After
+        user_agent: Optional User-Agent header
+
+    """
+    session = TimeoutSession(timeout=(connect_timeout, read_timeout))
+    retry = urllib3.util.Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS,
+        allowed_methods=("GET", "HEAD"),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_hosts,
+        pool_maxsize=pool_size,
+        max_retries=retry,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    if user_agent is not None:
+        session.headers["User-Agent"] = user_agent
+    _L.debug(
+        "Session pool_size=%s timeout=%s retries=%s",
+        pool_size,
+        session.timeout,
+        retries,
+    )
+    return session
@@ -0,0 +1,226 @@
+"""
+Benchmarks for crawling and loading synthetic sitemaps.
+
+Generates sitemap trees in a temporary folder, serves them with
+tests.testserver.TestServer and measures end to end SiteMap iteration and
+smcat.loadSitemap into SQLite. Each measurement runs in a fresh process so
+peak RSS is reported per run.
+
+Run with:
+
+    python -m tests.benchmark -o bench.json
+
+and compare the JSON output between releases.
+"""
+import concurrent.futures
+import datetime
+import gzip
+import json
+import multiprocessing
+import pathlib
+import platform
+import resource
+import sys
+import tempfile
+import time
+import click
+import smcat
+import smcat.models
+import smcat.sitemap
+import tests.testserver
+
+URLSET_HEAD = '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+URLSET_TAIL = "</urlset>\n"
+INDEX_HEAD = '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+INDEX_TAIL = "</sitemapindex>\n"
+
+# How each run consumes the sitemap
+MODES = ("items", "records", "streaming", "load")
+
+
+def urlsetDocument(prefix, n, start=0):
+    t0 = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    parts = [URLSET_HEAD]
+    for i in range(start, start + n):
+        lastmod = (t0 + datetime.timedelta(seconds=i)).isoformat()
+        parts.append(
+            f"<url><loc>{prefix}{i}</loc><lastmod>{lastmod}</lastmod>"
+            f"<changefreq>daily</changefreq><priority>0.5</priority></url>\n"
+        )
+    parts.append(URLSET_TAIL)
+    return "".join(parts).encode("utf-8")
+
+
+def indexDocument(locs):
+    parts = [INDEX_HEAD]
+    for loc in locs:
+        parts.append(
+            f"<sitemap><loc>{loc}</loc><lastmod>2020-01-01T00:00:00Z</lastmod></sitemap>\n"
+        )
+    parts.append(INDEX_TAIL)
+    return "".join(parts).encode("utf-8")
+
+
+def writeDocument(folder, name, body, gzipped=False):
+    if gzipped:
+        name = name + ".gz"
+        body = gzip.compress(body)
+    (folder / name).write_bytes(body)
+    return name
+
+
+def generateTrees(folder, base_url, scale=1.0):
+    """
+    Write the synthetic sitemap trees to folder.
+
+    Returns a dict of scenario name to (root document name, expected url entries).
+    """
+    folder = pathlib.Path(folder)
+    n_children = max(2, int(2000 * scale))
+    n_child_entries = 100
+    n_large = max(10, int(50000 * scale))
+    scenarios = {}
+
+    # Index with thousands of small children, alternating plain and gzipped
+    locs = []
+    for c in range(n_children):
+        name = writeDocument(
+            folder,
+            f"wide-{c:05d}.xml",
+            urlsetDocument(f"https://example.net/wide/{c}/", n_child_entries),
+            gzipped=(c % 2 == 1),
+        )
+        locs.append(base_url + name)
+    writeDocument(folder, "wide-index.xml", indexDocument(locs))
+    scenarios["wide_index"] = ("wide-index.xml", n_children * n_child_entries)
+
+    # Single large urlset, plain and gzipped
+    body = urlsetDocument("https://example.net/large/", n_large)
+    scenarios["large_urlset"] = (writeDocument(folder, "large.xml", body), n_large)
+    scenarios["large_urlset_gz"] = (
+        writeDocument(folder, "large.xml", body, gzipped=True),
+        n_large,
+    )
+
+    # Malformed documents, crawled through an index
+    ok = urlsetDocument("https://example.net/bad/", n_child_entries)
+    bad = []
+    bad.append(writeDocument(folder, "bad-truncated.xml", ok[: len(ok) // 2]))
+    gz = gzip.compress(ok)
+    (folder / "bad-truncated.xml.gz").write_bytes(gz[: len(gz) // 2])
+    bad.append("bad-truncated.xml.gz")
+    # Corrupt the CRC32 in the gzip trailer
+    (folder / "bad-crc.xml.gz").write_bytes(gz[:-8] + b"\0\0\0\0" + gz[-4:])
+    bad.append("bad-crc.xml.gz")
+    bad.append(writeDocument(folder, "bad-html.xml", b"<html><body>Not a sitemap</body></html>"))
+    writeDocument(folder, "bad-index.xml", indexDocument([base_url + b for b in bad]))
+    scenarios["malformed"] = ("bad-index.xml", None)
+    return scenarios
+
+
+def runOnce(url, mode, db_path):
+    """Crawl url in the given mode, returning counts, timing and peak RSS"""
+    t0 = time.perf_counter()
+    entries = 0
+    if mode == "items":
+        for item in smcat.sitemap.SiteMap(url):
+            if item.get("kind") == "url":
+                entries += 1
+    elif mode in ("records", "streaming"):
+        sm = smcat.sitemap.SiteMap(url, streaming=(mode == "streaming"))
+        for record in sm.records():
+            if record.kind == "url":
+                entries += 1
+    elif mode == "load":
+        # Includes crawl checkpoints and the sweep of removed entries
+        engine = smcat.models.init_db(f"sqlite:///{db_path}")
+        smcat.loadSitemap(url, engine=engine)
+    else:
+        raise ValueError(f"Unknown mode: {mode}")
+    elapsed = time.perf_counter() - t0
+    if mode == "load":
+        with engine.connect() as conn:
+            entries = conn.exec_driver_sql(
+                "SELECT count(*) FROM sitemapentry WHERE t_removed IS NULL"
+            ).scalar()
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        maxrss *= 1024
+    return {
+        "entries": entries,
+        "seconds": elapsed,
+        "entries_per_second": entries / elapsed if elapsed > 0 else None,
+        "peak_rss_bytes": maxrss,
+    }
+
+
+def runBenchmarks(scale=1.0, modes=MODES, isolate=True, folder=None):
+    """Generate, serve and crawl the synthetic sitemaps, returning the results"""
+    with tempfile.TemporaryDirectory() as tmp:
+        folder = pathlib.Path(folder or tmp)
+        folder.mkdir(parents=True, exist_ok=True)
+        server = tests.testserver.TestServer(port=0, directory=folder, quiet=True)
+        server.start()
+        try:
+            base_url = server.getAddress()
+            scenarios = generateTrees(folder, base_url, scale=scale)
+            results = []
+            for name, (root, expected) in scenarios.items():
+                for mode in modes:
+                    db_path = pathlib.Path(tmp) / f"{name}-{mode}.db"
+                    requests_before = server.request_count
+                    if isolate:
+                        # A new process per run so peak RSS is not cumulative
+                        with concurrent.futures.ProcessPoolExecutor(
+                            max_workers=1,
+                            mp_context=multiprocessing.get_context("spawn"),
+                        ) as pool:
+                            result = pool.submit(
+                                runOnce, base_url + root, mode, db_path
+                            ).result()
+                    else:
+                        result = runOnce(base_url + root, mode, db_path)
+                    result["scenario"] = name
+                    result["mode"] = mode
+                    result["expected_entries"] = expected
+                    result["http_requests"] = server.request_count - requests_before
+                    results.append(result)
+        finally:
+            server.stop()
+    return {
+        "timestamp": datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": scale,
+        "results": results,
+    }
+
+
+@click.command()
+@click.option("-o", "--output", default=None, help="Write results as JSON to this file")
+@click.option("-s", "--scale", default=1.0, help="Multiplier for document sizes", show_default=True)
+@click.option(
+    "-m",
+    "--mode",
+    "modes",
+    multiple=True,
+    type=click.Choice(MODES),
+    help="Modes to run, default all",
+)
+def main(output, scale, modes):
+    report = runBenchmarks(scale=scale, modes=modes or MODES)
+    for r in report["results"]:
+        eps = r["entries_per_second"] or 0
+        print(
+            f"{r['scenario']:16} {r['mode']:10} {r['entries']:8d} entries "
+            f"{r['seconds']:8.3f}s {eps:10.0f}/s "
+            f"{r['peak_rss_bytes'] / 2**20:8.1f}MiB {r['http_requests']:5d} requests"
+        )
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
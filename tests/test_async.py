@@ -0,0 +1,51 @@
+import asyncio
+import pathlib
+import pytest
+import tests.testserver
+import smcat.sitemap
+
+httpx = pytest.importorskip("httpx")
+import smcat.asyncsitemap  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def address():
+    _server = tests.testserver.TestServer()
+    _server.start()
+    yield _server.getAddress()
+    _server.stop()
+
+
+async def _items(sm):
+    return [item async for item in sm]
+
+
+def test_async_items(address):
+    for name in ("smindex.xml", "robots.txt"):
+        url = f"{address}{name}"
+        expected = [item for item in smcat.sitemap.SiteMap(url)]
+        sm = smcat.asyncsitemap.AsyncSiteMap(url, max_concurrency=4)
+        assert asyncio.run(_items(sm)) == expected
+
+
+def test_async_stats(address):
+    sm = smcat.asyncsitemap.AsyncSiteMap(f"{address}sm01.xml")
+    asyncio.run(_items(sm))
+    data = pathlib.Path(__file__).parent / "data" / "sm01.xml"
+    assert sm.stats.sitemap(f"{address}sm01.xml").bytes == data.stat().st_size
+
+
+def test_async_many(address):
+    async def crawl():
+        sms = [
+            smcat.asyncsitemap.AsyncSiteMap(f"{address}smindex.xml", max_concurrency=2)
+            for _ in range(4)
+        ]
+        return await asyncio.gather(*[_items(sm) for sm in sms])
+
+    results = asyncio.run(crawl())
+    locs = [
+        [i["url"][smcat.sitemap.SM_LOC] for i in items if i.get("kind") == "url"]
+        for items in results
+    ]
+    assert all(len(x) == 6 for x in locs)
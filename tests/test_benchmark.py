@@ -0,0 +1,11 @@
+import tests.benchmark
+
+
+def test_benchmark_smoke(tmp_path):
+    report = tests.benchmark.runBenchmarks(
+        scale=0.002, modes=("records", "load"), isolate=False, folder=tmp_path
+    )
+    for result in report["results"]:
+        if result["expected_entries"] is not None:
+            assert result["entries"] == result["expected_entries"]
+        assert result["http_requests"] > 0
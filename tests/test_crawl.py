@@ -1,5 +1,15 @@
+import datetime
+import gzip
+import io
+import json
+import pathlib
+import re
 import pytest
+import sqlmodel
 import tests.testserver
+import smcat
+import smcat.export
+import smcat.models
 import smcat.sitemap
 
 @pytest.fixture(scope="module")
@@ -20,3 +30,354 @@ def test_robotstxt(address):
     for item in sm:
         print(item)
         items.append(item)
+
+
+def _locs(sm):
+    return [
+        item["url"][smcat.sitemap.SM_LOC]
+        for item in sm
+        if item.get("kind") == "url"
+    ]
+
+
+def test_concurrent_index(address):
+    url = f"{address}smindex.xml"
+    expected = _locs(smcat.sitemap.SiteMap(url))
+    assert len(expected) == 6
+    ordered = _locs(smcat.sitemap.SiteMap(url, max_workers=4))
+    assert ordered == expected
+    unordered = _locs(smcat.sitemap.SiteMap(url, max_workers=4, ordered=False))
+    assert sorted(unordered) == sorted(expected)
+
+
+def test_streaming(address):
+    url = f"{address}smindex.xml"
+    expected = _locs(smcat.sitemap.SiteMap(url))
+    assert _locs(smcat.sitemap.SiteMap(url, streaming=True)) == expected
+    gz = f"{address}sm01.xml.gz"
+    assert _locs(smcat.sitemap.SiteMap(gz, streaming=True)) == _locs(
+        smcat.sitemap.SiteMap(gz)
+    )
+
+
+def test_invalid_child(address):
+    url = f"{address}smempty.xml"
+    for kwargs in ({}, {"max_workers": 2}, {"streaming": True}, {"parse_workers": 1}):
+        assert len(_locs(smcat.sitemap.SiteMap(url, **kwargs))) == 3
+        sm = smcat.sitemap.SiteMap(url, **kwargs)
+        parsed = {
+            r.loc: r.extras["parsed"]
+            for r in sm.records(completed=True)
+            if r.kind == "completed"
+        }
+        assert parsed == {
+            f"{address}sm01.xml": True,
+            f"{address}empty.xml": False,
+            url: False,
+        }
+
+
+def test_conditional(address):
+    url = f"{address}sm02.xml"
+    validators = smcat.sitemap.ValidatorCache()
+    assert len(_locs(smcat.sitemap.SiteMap(url, validators=validators))) == 3
+    assert validators.get(url) is not None
+    assert _locs(smcat.sitemap.SiteMap(url, validators=validators)) == []
+
+
+def test_conditional_failed(address, tmp_path):
+    url = f"{address}smmissing.xml"
+    validators = smcat.sitemap.ValidatorCache()
+    assert len(_locs(smcat.sitemap.SiteMap(url, validators=validators))) == 3
+    assert validators.get(f"{address}sm01.xml") is not None
+    # Not stored for the index, a sitemap below it failed
+    assert validators.get(url) is None
+    server = tests.testserver.TestServer(port=0, directory=tmp_path, quiet=True)
+    server.start()
+    try:
+        url = f"{server.getAddress()}index.xml"
+        index = (pathlib.Path(__file__).parent / "data" / "smindex.xml").read_text()
+        (tmp_path / "index.xml").write_text(index.replace(address, server.getAddress()))
+        engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'conditional.db'}")
+        smcat.loadSitemap(url, engine=engine, conditional=True)
+        assert smcat.models.DatabaseValidatorCache(engine).get(url) is None
+        (tmp_path / "sm01.xml").write_bytes(
+            (pathlib.Path(__file__).parent / "data" / "sm01.xml").read_bytes()
+        )
+        (tmp_path / "sm02.xml").write_bytes(
+            (pathlib.Path(__file__).parent / "data" / "sm02.xml").read_bytes()
+        )
+        smcat.loadSitemap(url, engine=engine, conditional=True)
+        with smcat.models.get_session(engine) as session:
+            entries = session.exec(sqlmodel.select(smcat.models.SitemapEntry)).all()
+        assert len(entries) == 6
+        assert smcat.models.DatabaseValidatorCache(engine).get(url) is not None
+    finally:
+        server.stop()
+
+
+def test_incremental(address):
+    url = f"{address}smindex.xml"
+    index = [
+        item["url"]
+        for item in smcat.sitemap.SiteMap(url)
+        if item.get("kind") == "sitemap"
+    ]
+    known = {index[0][smcat.sitemap.SM_LOC]: index[0][smcat.sitemap.SM_LASTMOD]}
+    sm = smcat.sitemap.SiteMap(url, known_lastmod=known)
+    items = [item for item in sm if item.get("kind") is not None]
+    assert len([i for i in items if i["kind"] == "sitemap"]) == 2
+    assert len([i for i in items if i["kind"] == "url"]) == 3
+
+
+def test_incremental_failed(tmp_path):
+    data = pathlib.Path(__file__).parent / "data"
+    server = tests.testserver.TestServer(port=0, directory=tmp_path, quiet=True)
+    server.start()
+    try:
+        address = server.getAddress()
+        index = (data / "smindex.xml").read_text()
+        (tmp_path / "smindex.xml").write_text(index.replace("http://127.0.0.1:8001/", address))
+        (tmp_path / "sm01.xml").write_bytes((data / "sm01.xml").read_bytes())
+        engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'incremental.db'}")
+        url = f"{address}smindex.xml"
+        smcat.loadSitemap(url, engine=engine, incremental=True)
+        assert smcat.models.sitemapLastmods(engine).keys() == {f"{address}sm01.xml"}
+        # The child that failed is fetched again, though its lastmod is unchanged
+        (tmp_path / "sm02.xml").write_bytes((data / "sm02.xml").read_bytes())
+        sm = smcat.loadSitemap(url, engine=engine, incremental=True)
+        assert sm.parsed_sitemaps == {url, f"{address}sm02.xml"}
+        with smcat.models.get_session(engine) as session:
+            entries = session.exec(sqlmodel.select(smcat.models.SitemapEntry)).all()
+        assert len([e for e in entries if e.t_removed is None]) == 6
+    finally:
+        server.stop()
+
+
+def test_parse_workers(address):
+    url = f"{address}smindex.xml"
+    expected = _locs(smcat.sitemap.SiteMap(url))
+    assert _locs(smcat.sitemap.SiteMap(url, max_workers=2, parse_workers=2)) == expected
+
+
+def test_records(address):
+    url = f"{address}smindex.xml"
+    items = [
+        item for item in smcat.sitemap.SiteMap(url) if item.get("kind") is not None
+    ]
+    records = list(smcat.sitemap.SiteMap(url).records())
+    assert [r.asItem() for r in records] == items
+    assert [smcat.sitemap.SitemapRecord.fromItem(i) for i in items] == records
+
+
+def test_resume(address, tmp_path):
+    url = f"{address}smindex.xml"
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'resume.db'}")
+    # An interrupted crawl that committed the first child sitemap
+    crawl = smcat.models.startCrawl(engine, url)
+    smcat.models.addCheckpoint(engine, crawl.id, f"{address}sm01.xml", parsed=True)
+    sm = smcat.loadSitemap(url, engine=engine, resume=True)
+    assert sm.completed == {f"{address}sm01.xml"}
+    with smcat.models.get_session(engine) as session:
+        entries = session.exec(sqlmodel.select(smcat.models.SitemapEntry)).all()
+    assert len(entries) == 3
+    done = smcat.models.crawlCheckpoints(engine, crawl.id)
+    assert done == {url, f"{address}sm01.xml", f"{address}sm02.xml"}
+
+
+def test_resume_failed(address, tmp_path):
+    url = f"{address}smmissing.xml"
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'failed.db'}")
+    # A crawl interrupted after a child sitemap failed to load
+    crawl = smcat.models.startCrawl(engine, url)
+    smcat.addTreeToDatabase(
+        engine, smcat.sitemap.SiteMap(url).records(completed=True), crawl_id=crawl.id
+    )
+    sm = smcat.loadSitemap(url, engine=engine, resume=True)
+    assert f"{address}sm01.xml" in sm.completed
+    assert f"{address}missing.xml" not in sm.completed
+    assert sm.stats.sitemap(f"{address}missing.xml").status == 404
+
+
+def _removed(engine):
+    with smcat.models.get_session(engine) as session:
+        entries = session.exec(sqlmodel.select(smcat.models.SitemapEntry)).all()
+    return [e.loc for e in entries if e.t_removed is not None]
+
+
+def test_sweep_filtered(address, tmp_path):
+    url = f"{address}sm02.xml"
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'filtered.db'}")
+    smcat.loadSitemap(url, engine=engine)
+    start_from = datetime.datetime(2019, 9, 23, 12, 46, 30, tzinfo=datetime.timezone.utc)
+    sm = smcat.loadSitemap(url, engine=engine, start_from=start_from)
+    assert url not in sm.parsed_sitemaps
+    assert _removed(engine) == []
+
+
+def test_sweep_truncated(tmp_path):
+    body = (pathlib.Path(__file__).parent / "data" / "sm02.xml").read_bytes()
+    gz = gzip.compress(body)
+    server = tests.testserver.TestServer(port=0, directory=tmp_path, quiet=True)
+    server.start()
+    try:
+        url = f"{server.getAddress()}sm.xml.gz"
+        engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'truncated.db'}")
+        (tmp_path / "sm.xml.gz").write_bytes(gz)
+        smcat.loadSitemap(url, engine=engine)
+        (tmp_path / "sm.xml.gz").write_bytes(gz[: len(gz) * 2 // 3])
+        for kwargs in ({}, {"streaming": True}, {"max_workers": 2, "parse_workers": 1}):
+            sm = smcat.loadSitemap(url, engine=engine, **kwargs)
+            assert url not in sm.parsed_sitemaps
+        assert _removed(engine) == []
+        # Damaged after the end of the document
+        (tmp_path / "sm.xml.gz").write_bytes(gz[:-8] + b"\0\0\0\0" + gz[-4:])
+        assert url not in smcat.loadSitemap(url, engine=engine).parsed_sitemaps
+    finally:
+        server.stop()
+
+
+def test_host_limit(tmp_path):
+    server = tests.testserver.TestServer(port=0, quiet=True, body_delay=0.1)
+    server.start()
+    try:
+        roots = [f"{server.getAddress()}{n}" for n in ("sm01.xml", "sm02.xml", "sm01.xml.gz")]
+        engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'hosts.db'}")
+        smcat.syncSitemaps(roots, engine, workers=3, per_host=1)
+        assert server.request_count == 3
+        # Bodies are read within the host slot
+        assert server.max_active_requests == 1
+    finally:
+        server.stop()
+
+
+def test_sync(address, tmp_path):
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'sync.db'}")
+    roots = [f"{address}smindex.xml", f"{address}sm02.xml", f"{address}missing.xml"]
+    results = smcat.syncSitemaps(roots, engine, workers=3, per_host=2)
+    assert set(results.keys()) == set(roots)
+    assert results[roots[0]]["sitemapentry"].total == 6
+    assert results[roots[1]]["sitemapentry"].total == 3
+    inserted = sum(results[r]["sitemapentry"].inserted for r in roots)
+    assert inserted == 6
+    # Overlapping roots do not remove each other's entries
+    assert smcat.models.sweepRemoved(engine, 1)["sitemapentry"] == 0
+    assert set(smcat.models.getCrawlRoots(engine)) == set(roots)
+
+
+def test_write_records(address):
+    sm = smcat.sitemap.SiteMap(f"{address}smindex.xml", streaming=True)
+    dest = io.StringIO()
+    n = smcat.export.writeRecords(sm.records(completed=True), dest)
+    lines = dest.getvalue().splitlines()
+    assert n == len(lines) == 6
+    assert all(json.loads(line)["kind"] == "url" for line in lines)
+
+
+def test_stats(address, tmp_path):
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'stats.db'}")
+    sm = smcat.loadSitemap(f"{address}smindex.xml", engine=engine, streaming=True)
+    totals = sm.stats.totals()
+    assert len(sm.stats.sitemaps) == 3
+    assert totals.entries == 8
+    assert totals.bytes > 0
+    child = sm.stats.sitemap(f"{address}sm01.xml")
+    assert child.status == 200
+    assert child.flush_seconds > 0
+
+
+def test_gunzip_damaged():
+    body = (pathlib.Path(__file__).parent / "data" / "sm02.xml").read_bytes()
+    gz = gzip.compress(body)
+    assert smcat.sitemap.gunzip(gz) == body
+    # Bad CRC and truncated data still give what could be decompressed
+    truncated = []
+    damaged = smcat.sitemap.gunzip(
+        gz[:-8] + b"\0\0\0\0" + gz[-4:], on_truncated=lambda: truncated.append(1)
+    )
+    assert damaged == body and truncated == [1]
+    part = smcat.sitemap.gunzip(gz[: len(gz) // 2], on_truncated=lambda: truncated.append(2))
+    assert body.startswith(part) and truncated == [1, 2]
+    smcat.sitemap.gunzip(gz + gz, on_truncated=lambda: truncated.append(3))
+    assert truncated == [1, 2]
+    # The root element is not closed
+    assert not smcat.sitemap.SiteMapIterator(body).truncated
+    assert smcat.sitemap.SiteMapIterator(body[: len(body) // 2]).truncated
+
+
+def test_extensions(tmp_path):
+    body = b"""<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9"
+  xmlns:image="http://www.google.com/schemas/sitemap-image/1.1"
+  xmlns:news="http://www.google.com/schemas/sitemap-news/0.9"
+  xmlns:xhtml="http://www.w3.org/1999/xhtml">
+<url>
+  <loc>http://example.net/a</loc>
+  <news:news>
+    <news:publication><news:name>Example</news:name><news:language>en</news:language></news:publication>
+    <news:title>A</news:title>
+  </news:news>
+  <image:image><image:loc>http://example.net/1.jpg</image:loc></image:image>
+  <image:image><image:loc>http://example.net/2.jpg</image:loc></image:image>
+  <xhtml:link rel="alternate" hreflang="de" href="http://example.net/de/a"/>
+</url>
+</urlset>"""
+    s = smcat.sitemap.SiteMapIterator(body)
+    record = next(s.records())
+    assert record.extras == {
+        smcat.sitemap.SM_NEWS: {
+            "publication": {"name": "Example", "language": "en"},
+            "title": "A",
+        },
+        smcat.sitemap.SM_IMAGE: [
+            {"loc": "http://example.net/1.jpg"},
+            {"loc": "http://example.net/2.jpg"},
+        ],
+    }
+    s.handlers = smcat.sitemap.extensionHandlers(alternate_links=True)
+    record = next(s.records())
+    assert record.extras[smcat.sitemap.SM_XHTML_LINK] == [
+        {"rel": "alternate", "hreflang": "de", "href": "http://example.net/de/a"}
+    ]
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'ext.db'}")
+    smcat.addTreeToDatabase(engine, [record])
+    with smcat.models.get_session(engine) as session:
+        entry = session.exec(sqlmodel.select(smcat.models.SitemapEntry)).one()
+    assert entry.properties == record.extras
+
+
+def test_rule_matcher():
+    rules = smcat.sitemap.RuleMatcher(
+        [("/b", "b"), (re.compile("A", re.I), "a"), (r"(x)\1", "xx"), ("^http", "any")]
+    )
+    # The first rule in order wins, not the earliest match in the url
+    assert rules.match("http://xa/b") == "b"
+    assert rules.match("http://xa/c") == "a"
+    assert rules.match("http://xx/") == "xx"
+    assert rules.match("http://y/") == "any"
+    assert rules.match("ftp://y/") is None
+
+
+def test_start_from(address):
+    start_from = datetime.datetime(2019, 9, 23, 12, 46, 30, tzinfo=datetime.timezone.utc)
+    sm = smcat.sitemap.SiteMap(f"{address}sm02.xml", start_from=start_from)
+    items = [i["url"] for i in sm if i.get("kind") == "url"]
+    records = [r for r in sm.records() if r.kind == "url"]
+    assert len(records) == 2
+    assert [i[smcat.sitemap.SM_LOC] for i in items] == [r.loc for r in records]
+
+
+def test_cycles(address):
+    url = f"{address}smcycle.xml"
+    sm = smcat.sitemap.SiteMap(url)
+    locs = _locs(sm)
+    # Itself and the repeated sm02.xml are not fetched again
+    assert len(locs) == len(set(locs)) == 6
+    assert sorted(sm.visited) == sorted(
+        [url] + [f"{address}{n}" for n in ("smindex.xml", "sm01.xml", "sm02.xml")]
+    )
+    records = [r for r in sm.records() if r.kind == "url"]
+    assert [r.loc for r in records] == locs
+    # Children of smindex.xml are beyond max_depth, sm02.xml is then followed
+    sm = smcat.sitemap.SiteMap(url, max_depth=1)
+    assert len(_locs(sm)) == len([r for r in sm.records() if r.kind == "url"]) == 3
@@ -0,0 +1,25 @@
+import datetime
+import smcat.sitemap
+
+UTC = datetime.timezone.utc
+
+
+def test_w3c_formats():
+    parse = smcat.sitemap.parseW3CDatetime
+    assert parse("2019") == datetime.datetime(2019, 1, 1)
+    assert parse("2019-09") == datetime.datetime(2019, 9, 1)
+    assert parse("2019-09-23") == datetime.datetime(2019, 9, 23)
+    assert parse("2019-09-23T13:46Z") == datetime.datetime(2019, 9, 23, 13, 46, tzinfo=UTC)
+    assert parse("2019-09-23T13:46:37+01:00") == datetime.datetime(
+        2019, 9, 23, 12, 46, 37, tzinfo=UTC
+    )
+    assert parse("2019-09-23T13:46:37.5Z") == datetime.datetime(
+        2019, 9, 23, 13, 46, 37, 500000, tzinfo=UTC
+    )
+
+
+def test_lastmod_failure():
+    assert smcat.sitemap.parseLastmod("yesterday") == "yesterday"
+    assert smcat.sitemap.isLastmodFailure("yesterday")
+    assert smcat.sitemap.parseLastmod(None) is None
+    assert not smcat.sitemap.isLastmodFailure(None)
@@ -0,0 +1,10 @@
+import smcat.transport
+
+
+def test_session_defaults():
+    session = smcat.transport.createSession(pool_size=4, read_timeout=5, retries=2)
+    assert session.timeout == (smcat.transport.DEFAULT_CONNECT_TIMEOUT, 5)
+    adapter = session.get_adapter("https://example.net/")
+    assert adapter._pool_maxsize == 4
+    assert adapter.max_retries.total == 2
+    assert 429 in adapter.max_retries.status_forcelist
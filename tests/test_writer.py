@@ -0,0 +1,189 @@
+import csv
+import datetime
+import io
+import json
+import pytest
+import sqlmodel
+import smcat
+import smcat.export
+import smcat.models
+import smcat.sitemap
+
+
+def test_batch_upsert(tmp_path):
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'writer.db'}")
+    t0 = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    t1 = datetime.datetime(2022, 2, 1, tzinfo=datetime.timezone.utc)
+    results = []
+    with smcat.models.BatchWriter(engine, batch_size=2, on_batch=results.append) as writer:
+        writer.addIndex("http://example.net/sm.xml", lastmod=t0)
+        writer.addEntry("http://example.net/a", lastmod=t0, priority="0.5")
+        writer.addEntry("http://example.net/b", lastmod=t0)
+    entries = writer.totals["sitemapentry"]
+    assert entries.inserted == 2
+    with smcat.models.BatchWriter(engine) as writer:
+        writer.addEntry("http://example.net/a", lastmod=t0, priority="0.5")
+        writer.addEntry("http://example.net/b", lastmod=t1)
+        writer.addEntry("http://example.net/c", lastmod=t1)
+    entries = writer.totals["sitemapentry"]
+    assert (entries.inserted, entries.updated, entries.unchanged) == (1, 1, 1)
+    assert smcat.models.mostRecentEntry(engine).lastmod.replace(tzinfo=None) == t1.replace(tzinfo=None)
+
+
+def test_changed_since_pages(tmp_path):
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'pages.db'}")
+    t0 = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    with smcat.models.BatchWriter(engine) as writer:
+        for i in range(25):
+            lastmod = t0 + datetime.timedelta(days=i // 2)
+            writer.addEntry(f"http://example.net/{i:02d}", lastmod=lastmod)
+    since = t0 + datetime.timedelta(days=2)
+    expected = [e.loc for e in smcat.models.changedSince(engine, since)]
+    paged = [e.loc for e in smcat.models.iterChangedSince(engine, since, page_size=4)]
+    assert len(paged) == 19
+    assert sorted(paged) == sorted(expected)
+    assert paged == sorted(paged)
+
+
+def test_sweep_removed(tmp_path):
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'sweep.db'}")
+    t0 = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    source = "http://example.net/sm.xml"
+
+    def crawl(locs):
+        c = smcat.models.startCrawl(engine, source)
+        with smcat.models.BatchWriter(engine, generation=c.id) as writer:
+            writer.addIndex(source)
+            for loc in locs:
+                writer.addEntry(loc, lastmod=t0, source=source)
+        smcat.models.addCheckpoint(engine, c.id, source, parsed=True)
+        return smcat.models.sweepRemoved(engine, c.id)
+
+    assert crawl(["http://example.net/a", "http://example.net/b"])["sitemapentry"] == 0
+    assert crawl(["http://example.net/a"])["sitemapentry"] == 1
+    current = [e.loc for e in smcat.models.changedSince(engine, t0 - datetime.timedelta(days=1))]
+    assert current == ["http://example.net/a"]
+    removed = [
+        e for e in smcat.models.changedSince(engine, t0, include_removed=True)
+    ]
+    assert [(e.loc, e.t_removed is not None) for e in removed] == [("http://example.net/b", True)]
+    # Reappearing restores the entry
+    assert crawl(["http://example.net/a", "http://example.net/b"])["sitemapentry"] == 0
+    assert len(list(smcat.models.changedSince(engine, t0 - datetime.timedelta(days=1)))) == 2
+
+
+def test_init_db_indexes(tmp_path):
+    url = f"sqlite:///{tmp_path / 'indexes.db'}"
+    engine = smcat.models.init_db(url)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX ix_sitemapentry_source_lastmod")
+    engine = smcat.models.init_db(url)
+    indexes = sqlmodel.inspect(engine).get_indexes("sitemapentry")
+    assert "ix_sitemapentry_source_lastmod" in [i["name"] for i in indexes]
+
+
+def test_export(tmp_path):
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'export.db'}")
+    t0 = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    with smcat.models.BatchWriter(engine) as writer:
+        writer.addIndex("http://example.net/sm.xml")
+        for i in range(5):
+            writer.addEntry(
+                f"http://example.net/{i}",
+                lastmod=t0 + datetime.timedelta(days=i),
+                source="http://example.net/sm.xml",
+            )
+    dest = io.StringIO()
+    n = smcat.export.exportEntries(engine, dest, since=t0, batch_size=2)
+    rows = [json.loads(line) for line in dest.getvalue().splitlines()]
+    assert n == len(rows) == 4
+    assert rows[0]["source"] == "http://example.net/sm.xml"
+    dest = io.StringIO()
+    smcat.export.exportEntries(engine, dest, format="csv", source="http://example.net/other.xml")
+    assert list(csv.reader(io.StringIO(dest.getvalue()))) == [list(smcat.export.COLUMNS)]
+
+
+def test_export_parquet(tmp_path):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'parquet.db'}")
+    t0 = datetime.datetime(
+        2019, 9, 23, 13, 46, 37, tzinfo=datetime.timezone(datetime.timedelta(hours=1))
+    )
+    with smcat.models.BatchWriter(engine) as writer:
+        writer.addEntry("http://example.net/a", lastmod=t0)
+    smcat.export.exportEntries(engine, tmp_path / "entries.parquet", format="parquet")
+    row = parquet.read_table(tmp_path / "entries.parquet").to_pylist()[0]
+    # Stored as the sitemap's local time, not labelled as UTC
+    assert row["lastmod"] == t0.replace(tzinfo=None)
+    assert row["t_created"].tzinfo is not None
+
+
+def test_duplicates(tmp_path):
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'dup.db'}")
+    t0 = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    t1 = datetime.datetime(2022, 2, 1, tzinfo=datetime.timezone.utc)
+    with smcat.models.BatchWriter(engine, batch_size=2) as writer:
+        writer.addEntry("http://example.net/a", lastmod=t0, source="s1")
+        writer.addEntry("http://example.net/b", lastmod=t1, source="s1")
+        # Flushed with the first batch, an older duplicate is dropped
+        writer.addEntry("http://example.net/b", lastmod=t0, source="s2")
+        writer.addEntry("http://example.net/a", lastmod=t1, source="s2")
+        # Compared with the lastmod kept when the duplicate was written
+        writer.addEntry("http://example.net/a", lastmod=t0, source="s3")
+        writer.addEntry("http://example.net/c", source="s2")
+    assert writer.duplicates == 3
+    with smcat.models.get_session(engine) as session:
+        rows = {
+            e.loc: (e.source, e.lastmod.replace(tzinfo=None))
+            for e in session.exec(sqlmodel.select(smcat.models.SitemapEntry))
+            if e.lastmod is not None
+        }
+    assert rows == {
+        "http://example.net/a": ("s2", t1.replace(tzinfo=None)),
+        "http://example.net/b": ("s1", t1.replace(tzinfo=None)),
+    }
+
+
+def test_key_set():
+    keys = smcat.models.writer.KeySet(capacity=4)
+    locs = [f"http://example.net/{i}" for i in range(100)]
+    assert all(keys.add(smcat.models.writer._locKey(loc)) for loc in locs)
+    assert not any(keys.add(smcat.models.writer._locKey(loc)) for loc in locs)
+    assert len(keys) == 100
+    assert smcat.models.writer._locKey("http://example.net/a") not in keys
+    assert keys.add(0) and 0 in keys
+
+
+def test_bulk_load(tmp_path):
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'bulk.db'}", bulk_load=True)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1
+    records = [
+        smcat.sitemap.SitemapRecord("url", f"http://example.net/{i}", source=None)
+        for i in range(25)
+    ]
+    totals = smcat.addTreeToDatabase(engine, records, commit_batch=10, writer_thread=True)
+    assert totals["sitemapentry"].inserted == 25
+    # Errors in the writer thread are raised in the caller
+    with pytest.raises(AttributeError):
+        smcat.addTreeToDatabase(engine, [object()], writer_thread=True)
+
+
+def test_fingerprint(tmp_path):
+    engine = smcat.models.init_db(f"sqlite:///{tmp_path / 'fp.db'}")
+    t0 = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def load(priority):
+        with smcat.models.BatchWriter(engine) as writer:
+            writer.addEntry("http://example.net/a", lastmod=t0)
+            writer.addEntry("http://example.net/b", lastmod=t0, priority=priority)
+        with smcat.models.get_session(engine) as session:
+            rows = session.exec(sqlmodel.select(smcat.models.SitemapEntry)).all()
+        return writer.totals["sitemapentry"], {r.loc: r.t_updated for r in rows}
+
+    _, first = load("0.5")
+    result, second = load("0.8")
+    assert (result.updated, result.unchanged) == (1, 1)
+    assert second["http://example.net/a"] == first["http://example.net/a"]
+    assert second["http://example.net/b"] > first["http://example.net/b"]
@@ -4,6 +4,7 @@ Runs a simple web server for testing.
 Serves content in the data folder relative to the location of this file.
 """
 import os
+import functools
 import pathlib
 import threading
 import socketserver
@@ -11,6 +12,7 @@ import http.server
 import urllib.parse
 import datetime
 import email
+import time
 from http import HTTPStatus
 
 TEST_PORT = 8001
@@ -21,14 +23,38 @@ class Handler(http.server.SimpleHTTPRequestHandler):
     indexes = ["index.htm", ]
 
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory=TEST_HOME, **kwargs)
+        directory = kwargs.pop("directory", TEST_HOME)
+        super().__init__(*args, directory=directory, **kwargs)
         self.extensions_map[".jsonld"] = "application/ld+json"
 
     def do_GET(self):
         parsed = urllib.parse.urlparse(self.path)
         query_string = parsed.query
         path = parsed.path
-        super().do_GET()
+        self._active = hasattr(self.server, "countRequest")
+        if self._active:
+            self.server.countRequest()
+        try:
+            super().do_GET()
+        finally:
+            self._finishRequest()
+
+    def _finishRequest(self):
+        if getattr(self, "_active", False):
+            self._active = False
+            self.server.finishRequest()
+
+    def copyfile(self, source, outputfile):
+        # Headers have been sent, delay the body to simulate a slow download
+        time.sleep(getattr(self.server, "body_delay", 0))
+        # Finished once the body starts, so a client reading it before its
+        # next request is never counted twice
+        self._finishRequest()
+        super().copyfile(source, outputfile)
+
+    def log_message(self, format, *args):
+        if not getattr(self.server, "quiet", False):
+            super().log_message(format, *args)
 
     def send_head(self):
         """Common code for GET and HEAD commands.
@@ -118,18 +144,78 @@ class Handler(http.server.SimpleHTTPRequestHandler):
             raise
 
 
+class CountingHTTPServer(http.server.ThreadingHTTPServer):
+    """
+    ThreadingHTTPServer that counts the GET requests it handles, and the
+    most that were waiting for their body to be sent at the same time.
+    Response bodies are sent body_delay seconds after their headers.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, *args, quiet=False, body_delay=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.quiet = quiet
+        self.body_delay = body_delay
+        self.request_count = 0
+        self.active_requests = 0
+        self.max_active_requests = 0
+        self._count_lock = threading.Lock()
+
+    def countRequest(self):
+        with self._count_lock:
+            self.request_count += 1
+            self.active_requests += 1
+            self.max_active_requests = max(
+                self.max_active_requests, self.active_requests
+            )
+
+    def finishRequest(self):
+        with self._count_lock:
+            self.active_requests -= 1
+
+
 class TestServer(threading.Thread):
+    """
+    Serves the data folder, or directory if provided, on port.
+
+    Use port=0 to bind to any free port, then getAddress() after start().
+    """
 
     def __init__(self, *args, **kwargs):
         self._port = kwargs.pop("port", TEST_PORT)
+        self._directory = kwargs.pop("directory", TEST_HOME)
+        self._quiet = kwargs.pop("quiet", False)
+        self._body_delay = kwargs.pop("body_delay", 0)
+        kwargs.setdefault("daemon", True)
         super().__init__(*args, **kwargs)
 
+    def start(self):
+        # Bind before starting the thread so requests can be made immediately
+        handler = functools.partial(Handler, directory=self._directory)
+        self.server = CountingHTTPServer(
+            ("127.0.0.1", self._port),
+            handler,
+            quiet=self._quiet,
+            body_delay=self._body_delay,
+        )
+        self._port = self.server.server_address[1]
+        super().start()
+
+    @property
+    def request_count(self):
+        return self.server.request_count
+
+    @property
+    def max_active_requests(self):
+        return self.server.max_active_requests
+
     def run(self):
-        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", self._port), Handler)
         self.server.serve_forever()
 
     def stop(self):
         self.server.shutdown()
+        self.server.server_close()
 
     def getAddress(self):
         return f"http://127.0.0.1:{self._port}/"